@@ -4,13 +4,21 @@ Upload images and get AI-powered descriptions
 
 Optimized with:
 - Thread pool for async image preprocessing
-- Request batching for better GPU utilization
+- Iteration-level batching for step-capable model backends
 - Gunicorn compatible
 """
 
 import torch
-from transformers import AutoModelForCausalLM
+from snapshot import is_snapshot, load_weights, peak_rss_mb
 from flask import Flask, request, jsonify
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:  # WebSocket streaming is optional
+    Sock = None
+try:
+    import greenlet
+except ImportError:  # only present with gevent workers; used by the profiler
+    greenlet = None
 from functools import wraps
 from PIL import Image
 import io
@@ -22,8 +30,33 @@ from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
 import threading
 import queue
+import tempfile
+import math
+import collections
+import sys
+import _thread
+import atexit
+import contextlib
+import shutil
+import signal
+import weakref
+import gc
+import struct
+from multiprocessing import shared_memory, resource_tracker
+import logging
+import random
+import select
+import socket
+import sqlite3
+import json
+import hmac
+import urllib.parse
+import http.client
+import ipaddress
+import ssl
 
 app = Flask(__name__)
+websocket = Sock(app) if Sock is not None else None
 
 # Global model variable
 moondream = None
@@ -33,13 +66,159 @@ moondream = None
 PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', '4'))
 preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS)
 
-# GPU inference lock - ensures only one inference at a time to prevent OOM
+# GPU inference lock - the moondream model keeps its KV cache on the module,
+# so a model that is not reentrant only runs one generation at a time
 gpu_lock = threading.Lock()
 
-# Batch processing settings
+# Model to serve: a Hugging Face model id or a local path, plus an optional revision
+MODEL_ID = os.environ.get('MODEL_ID', 'moondream/moondream-2b-2025-04-14')
+MODEL_REVISION = os.environ.get('MODEL_REVISION') or None
+# A MODEL_ID that points at a weight snapshot (scripts/export_snapshot.py) is
+# loaded from memory-mapped tensors, see snapshot.py.
+# Device the weights are moved to, and whether to torch.compile them.
+# MODEL_DEVICE=cpu MODEL_COMPILE=false is enough to measure cold start without a GPU.
+MODEL_DEVICE = os.environ.get('MODEL_DEVICE', 'cuda')
+MODEL_COMPILE = os.environ.get('MODEL_COMPILE', 'true').lower() == 'true'
+
+# Zero-downtime reload (/admin/reload, SIGHUP). Loading runs trust_remote_code,
+# so it is off unless explicitly enabled, /admin/reload needs ADMIN_API_KEY,
+# and only MODEL_ID or operator-listed targets can be loaded.
+MODEL_RELOAD_ENABLED = os.environ.get('MODEL_RELOAD_ENABLED', 'false').lower() == 'true'
+# Other revisions of MODEL_ID, and local model directories, that may be reloaded
+MODEL_RELOAD_REVISIONS = [r.strip() for r in os.environ.get('MODEL_RELOAD_REVISIONS', '').split(',') if r.strip()]
+MODEL_RELOAD_PATHS = [p.strip() for p in os.environ.get('MODEL_RELOAD_PATHS', '').split(',') if p.strip()]
+# How long to wait for in-flight requests to drop the previous model
+MODEL_RELEASE_TIMEOUT = float(os.environ.get('MODEL_RELEASE_TIMEOUT', '900'))
+
+# Inference ownership
+# "local": every process loads its own model (default).
+# "client": HTTP workers hand preprocessed images to a single inference-owner
+# process (python app.py --inference-owner) over shared memory and a Unix socket.
+INFERENCE_MODE = os.environ.get('INFERENCE_MODE', 'local').lower()
+INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET', '/tmp/moondream-inference.sock')
+# Extra time a client waits for the owner past the request deadline
+INFERENCE_GRACE = 5.0
+
+# Model backend: "moondream" (CUDA) or "stub" (CPU stand-in for testing)
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'moondream').lower()
+STUB_TOKEN_DELAY = float(os.environ.get('STUB_TOKEN_DELAY', '0.02'))
+
+# Memory-aware admission
+# GPU_MEMORY_BUDGET_MB=0 keeps the old behaviour: one request at a time.
+# Otherwise requests are admitted while their estimated memory fits the budget.
+# Only reentrant backends (the stub) then run admitted requests concurrently:
+# the moondream model keeps one KV cache on the module, so admitted requests
+# still take gpu_lock and run one at a time. For moondream the budget only
+# bounds what may queue for the GPU (e.g. image encodings held by waiters).
+GPU_MEMORY_BUDGET_MB = float(os.environ.get('GPU_MEMORY_BUDGET_MB', '0'))
+# Cost model coefficients (MB). Per-token KV cost is 24 layers x (K, V) x 2048 x bf16.
+COST_BASE_MB = float(os.environ.get('COST_BASE_MB', '256'))
+COST_PER_CROP_MB = float(os.environ.get('COST_PER_CROP_MB', '96'))
+COST_PER_TOKEN_MB = float(os.environ.get('COST_PER_TOKEN_MB', '0.1875'))
+# Moondream image preprocessing: overlapping 378px crops plus one global crop
+IMAGE_TOKENS = 729
+CROP_SIZE = 378
+CROP_WINDOW = 266
+MAX_CROPS = 12
+PROMPT_TOKENS = 32
+# Expected output tokens per caption length (capped by max_tokens)
+CAPTION_LENGTH_TOKENS = {'short': 64, 'normal': 256, 'long': 512}
+
+# Experimental iteration-level scheduler: keeps up to BATCH_SIZE sequences in
+# the decode loop; requests join after their prefill and leave as soon as they
+# finish. It only drives models with a step interface (prefill/decode_step),
+# which today is only the stub backend. Other models (moondream) ignore
+# BATCH_ENABLED with a warning and keep the admission/GPU-lock path.
 BATCH_ENABLED = os.environ.get('BATCH_ENABLED', 'false').lower() == 'true'
 BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '4'))
-BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', '0.1'))  # 100ms
+# KV block accounting for the scheduler: how many sequences may run at once is
+# bounded by KV_POOL_BLOCKS blocks of KV_BLOCK_TOKENS tokens. It allocates no
+# memory itself. KV_POOL_BLOCKS=0 sizes it from GPU_MEMORY_BUDGET_MB, or
+# BATCH_SIZE full-length sequences.
+KV_BLOCK_TOKENS = int(os.environ.get('KV_BLOCK_TOKENS', '16'))
+KV_POOL_BLOCKS = int(os.environ.get('KV_POOL_BLOCKS', '0'))
+
+# Generation budgets
+# DEFAULT_MAX_TOKENS applies when a request does not set max_tokens;
+# MAX_TOKENS_LIMIT caps whatever the client asks for.
+DEFAULT_MAX_TOKENS = int(os.environ.get('DEFAULT_MAX_TOKENS', '768'))
+MAX_TOKENS_LIMIT = int(os.environ.get('MAX_TOKENS_LIMIT', '2048'))
+# Server-side deadline per request (seconds). Keep it below the gunicorn
+# --timeout so we give up on the request before the worker gets killed.
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '110'))
+# How often to check for a closed client connection while waiting for the GPU
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Generation outcome counters (reported by /health)
+generation_stats = {
+    "completed": 0,
+    "truncated": 0,
+    "aborted_deadline": 0,
+    "aborted_disconnect": 0,
+}
+stats_lock = threading.Lock()
+
+# Upload-once image registry (/v1/images)
+IMAGE_STORE_TTL = float(os.environ.get('IMAGE_STORE_TTL', '600'))
+# The memory tier is bounded by decoded size (width * height * 3 bytes per image)
+# as well as by count: a few large uploads must not hold gigabytes of RAM
+IMAGE_STORE_MAX_MB = float(os.environ.get('IMAGE_STORE_MAX_MB', '512'))
+IMAGE_STORE_MAX_ITEMS = int(os.environ.get('IMAGE_STORE_MAX_ITEMS', '64'))
+# Encoded images hold GPU memory, so only the most recently used few keep one
+IMAGE_STORE_MAX_ENCODED = int(os.environ.get('IMAGE_STORE_MAX_ENCODED', '4'))
+IMAGE_STORE_DISK_ITEMS = int(os.environ.get('IMAGE_STORE_DISK_ITEMS', '1024'))
+IMAGE_STORE_DIR = os.environ.get(
+    'IMAGE_STORE_DIR', os.path.expanduser('~/.cache/moondream/images'))
+
+# WebSocket frame streams (/v1/stream)
+# Deadline for answering one frame; the next frame replaces it if it takes longer
+STREAM_FRAME_TIMEOUT = float(os.environ.get('STREAM_FRAME_TIMEOUT', '10'))
+STREAM_MAX_FRAME_BYTES = int(os.environ.get('STREAM_MAX_FRAME_BYTES', str(8 * 1024 * 1024)))
+# Time a client without the auth header has to send its auth message
+STREAM_AUTH_TIMEOUT = 10
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25, 'max_message_size': STREAM_MAX_FRAME_BYTES}
+
+# Asynchronous job queue (SQLite-backed so queued work survives restarts)
+JOBS_ENABLED = os.environ.get('JOBS_ENABLED', 'true').lower() == 'true'
+# Next to the model cache by default: that is the directory the shipped
+# docker-compose and k8s manifests keep on a volume
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', os.path.join(
+    os.environ.get('HF_HOME', os.path.expanduser('~/.cache/huggingface')), 'moondream', 'jobs.db'))
+# Finished jobs are deleted after this many seconds
+JOB_RETENTION_SECONDS = float(os.environ.get('JOB_RETENTION_SECONDS', '86400'))
+# Generation deadline of a job, counted from the moment a worker claims it
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '600'))
+# A running job whose worker has not finished it within the lease is requeued.
+# The lease must outlast the job deadline plus the grace an aborting
+# generation gets, or a job still running would be claimed a second time
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', str(JOB_TIMEOUT + 60)))
+if JOB_LEASE_SECONDS < JOB_TIMEOUT + INFERENCE_GRACE + 30:
+    print(f"⚠ JOB_LEASE_SECONDS={JOB_LEASE_SECONDS:g} does not outlast JOB_TIMEOUT; "
+          f"using {JOB_TIMEOUT + INFERENCE_GRACE + 30:g}")
+    JOB_LEASE_SECONDS = JOB_TIMEOUT + INFERENCE_GRACE + 30
+# A job claimed this many times without finishing (e.g. it keeps crashing the
+# worker) is failed instead of being requeued again
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = 1.0
+CALLBACK_TIMEOUT = 10
+# Comma-separated host names callbacks may be sent to. When unset, callbacks
+# are only sent to hosts that resolve to public addresses (no loopback,
+# private, link-local or otherwise reserved ranges)
+JOB_CALLBACK_HOSTS = {h.strip().lower() for h in os.environ.get('JOB_CALLBACK_HOSTS', '').split(',') if h.strip()}
+
+# On-demand profiling (/debug/profile)
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_MAX_DEPTH = 64
+
+# Structured logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Fraction of records kept per level, e.g. "debug=0.01,info=1"
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'debug=0.01')
+# Records buffered for the background writer; newer records are dropped when full
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_FLUSH_INTERVAL = 0.05
 
 # API Key for X-Moondream-Auth header (standard Moondream API)
 # Read from VLM_API_KEY environment variable
@@ -47,46 +226,171 @@ VLM_API_KEY = os.environ.get('VLM_API_KEY', '')
 if VLM_API_KEY:
     print(f"✓ API Key authentication enabled (X-Moondream-Auth)")
 
+# Separate key for /admin endpoints (X-Moondream-Admin-Auth header).
+# Admin endpoints are disabled when it is not set.
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')
+if PROFILING_ENABLED and not ADMIN_API_KEY:
+    print("⚠ PROFILING_ENABLED without ADMIN_API_KEY: /debug/profile is disabled")
+
 # Hugging Face token
 HF_TOKEN = os.environ.get('HF_TOKEN', '')
 
+def keys_match(given, expected):
+    """Constant-time comparison of a presented key with the configured one"""
+    return hmac.compare_digest((given or '').encode('utf-8'), expected.encode('utf-8'))
+
+def api_key_valid(api_key):
+    """Check an API key against VLM_API_KEY (always valid when no key is set)"""
+    return not VLM_API_KEY or keys_match(api_key, VLM_API_KEY)
+
 def api_key_required(f):
     """Decorator that requires X-Moondream-Auth API key"""
     @wraps(f)
     def decorated(*args, **kwargs):
-        if VLM_API_KEY:
-            api_key = request.headers.get('X-Moondream-Auth', '')
-            if api_key != VLM_API_KEY:
-                return jsonify({"error": "Invalid or missing API key"}), 401
+        if not api_key_valid(request.headers.get('X-Moondream-Auth', '')):
+            return jsonify({"error": "Invalid or missing API key"}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+def admin_key_required(f):
+    """Decorator that requires the X-Moondream-Admin-Auth key; refuses everything when ADMIN_API_KEY is unset"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_API_KEY:
+            return jsonify({"error": "Admin endpoints are disabled (set ADMIN_API_KEY)"}), 404
+        if not keys_match(request.headers.get('X-Moondream-Admin-Auth'), ADMIN_API_KEY):
+            return jsonify({"error": "Invalid or missing admin key"}), 401
         return f(*args, **kwargs)
     return decorated
 
+class StubMoondream:
+    """
+    CPU stand-in for the moondream model (MODEL_BACKEND=stub).
+    Streams deterministic words with a fixed per-token delay so scheduling,
+    admission and cancellation can be exercised without a GPU.
+    """
+
+    reentrant = True
+
+    def __init__(self, token_delay=STUB_TOKEN_DELAY):
+        self.token_delay = token_delay
+
+    def compile(self):
+        pass
+
+    def _generate(self, words, settings):
+        limit = (settings or {}).get('max_tokens', len(words))
+        for word in words[:limit]:
+            time.sleep(self.token_delay)
+            yield word + ' '
+
+    def _respond(self, key, words, stream, settings):
+        tokens = self._generate(words, settings)
+        return {key: tokens if stream else ''.join(tokens)}
+
+    def _caption_words(self, image, length):
+        n = CAPTION_LENGTH_TOKENS.get(length, CAPTION_LENGTH_TOKENS['normal']) // 4
+        return [f"{image.width}x{image.height}"] + [f"caption{i}" for i in range(n - 1)]
+
+    def _query_words(self, image, question):
+        return [f"{image.width}x{image.height}"] + question.split()
+
+    def caption(self, image, length='normal', stream=False, settings=None):
+        return self._respond("caption", self._caption_words(image, length), stream, settings)
+
+    def query(self, image, question, stream=False, settings=None):
+        return self._respond("answer", self._query_words(image, question), stream, settings)
+
+    def encode_image(self, image):
+        return StubEncodedImage(image.width, image.height)
+
+    # Step interface used by the iteration-level batcher
+
+    def prefill(self, op, kv_blocks, image, length='normal', question=None):
+        """Run the prompt for one sequence; returns its decode state"""
+        time.sleep(self.token_delay)
+        if op == 'caption':
+            words = self._caption_words(image, length)
+        else:
+            words = self._query_words(image, question)
+        return collections.deque(words)
+
+    def decode_step(self, states):
+        """One decode step for every running sequence: a token each, or None when finished"""
+        time.sleep(self.token_delay)
+        return [state.popleft() + ' ' if state else None for state in states]
+
+
+StubEncodedImage = collections.namedtuple('StubEncodedImage', ['width', 'height'])
+
+
+def load_pretrained(model_id, revision=None):
+    """Load a model from a snapshot, a Hugging Face id or a local path onto MODEL_DEVICE"""
+    return load_weights(model_id, revision, HF_TOKEN).to(MODEL_DEVICE)
+
+
+def build_model(model_id, revision=None):
+    """Load and compile a model from a snapshot, a Hugging Face id or a local path"""
+    if MODEL_BACKEND == 'stub':
+        return StubMoondream()
+
+    model = load_pretrained(model_id, revision)
+    if MODEL_COMPILE:
+        print("Compiling model (this may take a minute)...")
+        model.compile()
+    return model
+
+
+def warm_up(model):
+    """
+    Run a tiny generation so compilation and CUDA setup happen before serving.
+    It is admitted like any request, so it never runs beside live generations
+    beyond the memory budget (or at all, for a model that is not reentrant).
+    """
+    image = Image.new('RGB', (CROP_SIZE, CROP_SIZE))
+    deadline = time.time() + REQUEST_DEADLINE
+    exclusive = not getattr(model, 'reentrant', False)
+    with admitted(admission_cost(image, 4, 'short'), deadline, exclusive=exclusive):
+        result = model.caption(image, length='short', stream=True, settings={"max_tokens": 4})
+        consume_stream(result['caption'], 4, deadline)
+
+
 def load_model():
     """Load Moondream2 model"""
     global moondream
-    print("Loading Moondream-2B model...")
+    if INFERENCE_MODE == 'client':
+        moondream = RemoteModel(INFERENCE_SOCKET)
+        print(f"✓ Using inference owner at {INFERENCE_SOCKET}")
+        return
+
+    if MODEL_BACKEND == 'stub':
+        moondream = build_model(MODEL_ID, MODEL_REVISION)
+        set_active_model(MODEL_ID, MODEL_REVISION)
+        print(f"✓ Stub model loaded (token delay: {STUB_TOKEN_DELAY}s)")
+        return
+
+    print(f"Loading model {MODEL_ID}" + (f" @ {MODEL_REVISION}" if MODEL_REVISION else "") + "...")
     print("This may take a few minutes for the first download...")
 
-    # Load model with specific config to avoid transformers compatibility issues
-    moondream = AutoModelForCausalLM.from_pretrained(
-        "moondream/moondream-2b-2025-04-14",
-        trust_remote_code=True,
-        token=HF_TOKEN,
-        torch_dtype=torch.bfloat16,
-        attn_implementation="eager",
-        low_cpu_mem_usage=True,
-    ).cuda()  # Manually move to CUDA
-
-    print("Compiling model (this may take a minute)...")
-    moondream.compile()
-    print("✓ Model loaded and ready!")
+    start = time.perf_counter()
+    moondream = build_model(MODEL_ID, MODEL_REVISION)
+    set_active_model(MODEL_ID, MODEL_REVISION, time.perf_counter() - start)
+    print(f"✓ Model loaded and ready! ({active_model['load_seconds']}s, peak RSS {peak_rss_mb()} MB"
+          + (", snapshot" if is_snapshot(MODEL_ID) else "") + ")")
 
     # Print optimization settings
     print(f"✓ Preprocess thread pool: {PREPROCESS_WORKERS} workers")
-    print(f"✓ Batch processing: {'enabled' if BATCH_ENABLED else 'disabled'}")
-    if BATCH_ENABLED:
-        print(f"  - Batch size: {BATCH_SIZE}")
-        print(f"  - Batch timeout: {BATCH_TIMEOUT}s")
+    if GPU_MEMORY_BUDGET_MB > 0 and not getattr(moondream, 'reentrant', False):
+        print(f"⚠ GPU_MEMORY_BUDGET_MB={GPU_MEMORY_BUDGET_MB:g}: this model is not reentrant, "
+              "so admitted requests still run one at a time")
+    if not BATCH_ENABLED:
+        print("✓ Iteration-level batching: disabled")
+    elif supports_batching(moondream):
+        print(f"✓ Iteration-level batching (experimental): up to {BATCH_SIZE} running sequences, "
+              f"{batcher.pool.num_blocks} KV blocks x {KV_BLOCK_TOKENS} tokens")
+    else:
+        print(f"⚠ BATCH_ENABLED is ignored: {type(moondream).__name__} has no prefill/decode_step, "
+              "requests run through admission and the GPU lock")
 
     # Print auth status
     if VLM_API_KEY:
@@ -103,21 +407,1015 @@ def preprocess_image_async(image_url):
     return preprocess_pool.submit(decode_base64_image, image_url)
 
 
-def run_inference_with_lock(func, *args, **kwargs):
+class ImageNotFound(Exception):
+    """Raised when an image_id is unknown or has expired"""
+
+
+# In client mode the image registry lives in the inference owner; HTTP workers
+# pass it the image_id instead of the image
+StoredImage = collections.namedtuple('StoredImage', ['image_id'])
+
+
+def load_request_image(data):
     """
-    Run GPU inference with lock to prevent concurrent GPU access.
-    This ensures only one inference runs at a time, preventing OOM errors.
+    Return the image for a caption/query request body: the stored encoding or
+    image for image_id, otherwise the decoded image_url.
     """
-    with gpu_lock:
-        return func(*args, **kwargs)
+    image_id = data.get('image_id')
+    if image_id and INFERENCE_MODE == 'client':
+        return StoredImage(image_id)
+    if image_id:
+        entry = image_store.get(image_id)
+        if entry is None:
+            raise ImageNotFound(f"Unknown or expired image_id: {image_id}")
+        image, encoded = entry
+        return encoded if encoded is not None else image
+
+    # Async preprocess: submit to thread pool (non-blocking for other requests)
+    preprocess_future = preprocess_image_async(data['image_url'])
+
+    # Wait for preprocessing to complete
+    return preprocess_future.result()
+
+
+class GenerationAborted(Exception):
+    """Raised when a generation is abandoned before it produced a result"""
+
+    def __init__(self, reason, partial=''):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial = partial
+
+
+def record_generation(outcome):
+    """Increment a generation outcome counter"""
+    with stats_lock:
+        generation_stats[outcome] += 1
+
+
+def get_client_socket():
+    """Return the raw client socket of the current request, if the server exposes it"""
+    return request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+
+
+def disconnect_watcher():
+    """Return a callable that reports whether the current request's client has gone away"""
+    sock = get_client_socket()
+    return lambda: client_disconnected(sock)
+
+
+def client_disconnected(sock):
+    """
+    Check whether the client has closed its connection.
+    A readable socket that returns no data on peek means EOF from the peer.
+    """
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+def parse_max_tokens(data):
+    """Read max_tokens from the request body, applying the default and the limit"""
+    max_tokens = data.get('max_tokens', DEFAULT_MAX_TOKENS)
+    if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1:
+        raise ValueError("max_tokens must be a positive integer")
+    return min(max_tokens, MAX_TOKENS_LIMIT)
+
+
+def parse_generation_budget(data, start_time):
+    """
+    Read max_tokens and timeout from the request body.
+    Returns (max_tokens, deadline) where deadline is an absolute time.time() value.
+    """
+    max_tokens = parse_max_tokens(data)
+
+    timeout = data.get('timeout', REQUEST_DEADLINE)
+    if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0:
+        raise ValueError("timeout must be a positive number of seconds")
+    timeout = min(float(timeout), REQUEST_DEADLINE)
+
+    return max_tokens, start_time + timeout
+
+
+def estimate_crops(width, height):
+    """Number of vision encoder crops moondream produces for an image (local crops + global crop)"""
+    if width <= CROP_SIZE and height <= CROP_SIZE:
+        return 1
+    tiles_h = math.ceil(height / CROP_WINDOW)
+    tiles_w = math.ceil(width / CROP_WINDOW)
+    if tiles_h * tiles_w > MAX_CROPS:
+        ratio = math.sqrt(MAX_CROPS / (tiles_h * tiles_w))
+        tiles_h = max(1, math.floor(tiles_h * ratio))
+        tiles_w = max(1, math.floor(tiles_w * ratio))
+    return tiles_h * tiles_w + 1
+
+
+def output_token_estimate(max_tokens, length=None):
+    """Expected number of generated tokens for a request"""
+    if length is not None:
+        return min(max_tokens, CAPTION_LENGTH_TOKENS.get(length, max_tokens))
+    return max_tokens
+
+
+def estimate_batch_cost(items):
+    """
+    Estimate GPU memory (MB) for running items together.
+    items is a list of (crops, output_tokens). Vision activations add up per
+    crop; KV caches are padded to the longest sequence in the batch.
+    """
+    if not items:
+        return 0.0
+    vision = sum(crops for crops, _ in items) * COST_PER_CROP_MB
+    longest = max(IMAGE_TOKENS + PROMPT_TOKENS + tokens for _, tokens in items)
+    kv = len(items) * longest * COST_PER_TOKEN_MB
+    return COST_BASE_MB + vision + kv
+
+
+def estimate_request_cost(image, max_tokens, length=None):
+    """
+    Estimate GPU memory (MB) for a single caption/query request.
+    An already encoded image needs no vision encoder pass.
+    """
+    crops = estimate_crops(*image.size) if isinstance(image, Image.Image) else 0
+    return estimate_batch_cost([(crops, output_token_estimate(max_tokens, length))])
+
+
+def admission_cost(image, max_tokens, length=None):
+    """Admission reservation for a request: its estimate, or the whole budget without one"""
+    if GPU_MEMORY_BUDGET_MB > 0:
+        return estimate_request_cost(image, max_tokens, length)
+    return admission.budget_mb
+
+
+class MemoryAdmission:
+    """
+    First-come first-served admission of work against a memory budget (MB).
+    A request larger than the whole budget is admitted alone.
+    """
+
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.in_use_mb = 0.0
+        self.peak_mb = 0.0
+        self.active = 0
+        self._cond = threading.Condition()
+        self._waiting = collections.deque()
+
+    def _clamp(self, cost_mb):
+        return min(cost_mb, self.budget_mb)
+
+    def acquire(self, cost_mb, timeout=None, cancelled=None):
+        """
+        Reserve cost_mb, in arrival order. The caller keeps its place in the
+        queue for the whole wait. Returns False if it could not be admitted
+        within timeout, or cancelled() reported the request gone while waiting.
+        """
+        cost = self._clamp(cost_mb)
+        end = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._waiting[0] is ticket and self.in_use_mb + cost <= self.budget_mb:
+                        self._waiting.popleft()
+                        self.in_use_mb += cost
+                        self.peak_mb = max(self.peak_mb, self.in_use_mb)
+                        self.active += 1
+                        return True
+                    remaining = None if end is None else end - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    if cancelled is not None and (remaining is None or remaining > DISCONNECT_POLL_INTERVAL):
+                        remaining = DISCONNECT_POLL_INTERVAL
+                    self._cond.wait(remaining)
+                # Outside the lock: cancelled() may poll a socket
+                if cancelled is not None and cancelled():
+                    return False
+        finally:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                # The next waiter may fit now that the head has moved
+                self._cond.notify_all()
+
+    def release(self, cost_mb):
+        with self._cond:
+            self.in_use_mb = max(0.0, self.in_use_mb - self._clamp(cost_mb))
+            self.active -= 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "budget_mb": self.budget_mb,
+                "in_use_mb": round(self.in_use_mb, 1),
+                "peak_mb": round(self.peak_mb, 1),
+                "active": self.active,
+                "waiting": len(self._waiting),
+            }
 
-def decode_base64_image(image_url):
-    """Decode base64 image from data URL"""
-    if image_url.startswith('data:image/'):
-        # Extract the base64 part after the comma
-        header, encoded = image_url.split(',', 1)
-        image_bytes = base64.b64decode(encoded, validate=True)
 
+# Without a configured budget every request reserves the whole (unit) budget
+admission = MemoryAdmission(GPU_MEMORY_BUDGET_MB if GPU_MEMORY_BUDGET_MB > 0 else 1.0)
+
+
+def wait_for(acquire, deadline, cancelled=None):
+    """
+    Call acquire(timeout) until it succeeds, giving up when the deadline
+    passes or cancelled() reports that the client has gone away.
+    """
+    while not acquire(max(0.0, min(DISCONNECT_POLL_INTERVAL, deadline - time.time()))):
+        if time.time() >= deadline:
+            record_generation("aborted_deadline")
+            raise GenerationAborted("deadline")
+        if cancelled is not None and cancelled():
+            record_generation("aborted_disconnect")
+            raise GenerationAborted("disconnect")
+
+
+@contextlib.contextmanager
+def admitted(cost, deadline, cancelled=None, exclusive=True):
+    """
+    Hold an admission reservation of cost MB (and the GPU lock when the model
+    is not reentrant) for the duration of the block.
+    """
+    # Wait for admission, checking periodically whether the request is still wanted
+    with span('lock_wait'):
+        if not admission.acquire(cost, max(0.0, deadline - time.time()), cancelled):
+            if time.time() >= deadline:
+                record_generation("aborted_deadline")
+                raise GenerationAborted("deadline")
+            record_generation("aborted_disconnect")
+            raise GenerationAborted("disconnect")
+        try:
+            if exclusive:
+                wait_for(lambda timeout: gpu_lock.acquire(timeout=timeout), deadline, cancelled)
+        except GenerationAborted:
+            admission.release(cost)
+            raise
+
+    try:
+        yield
+    finally:
+        if exclusive:
+            gpu_lock.release()
+        admission.release(cost)
+
+
+def token_counter(model):
+    """
+    Return a callable counting the tokens in generated text with the model's
+    tokenizer, or None when the model has none (the stub streams one token
+    per chunk).
+    """
+    tokenizer = getattr(model, 'tokenizer', None) or getattr(getattr(model, 'model', None), 'tokenizer', None)
+    if tokenizer is None:
+        return None
+
+    def count(text):
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        return len(getattr(ids, 'ids', ids))
+    return count
+
+
+def consume_stream(stream, max_tokens, deadline, cancelled=None, count_tokens=None):
+    """
+    Read a streaming generation until it ends or one of its budgets runs out.
+    Returns (text, finish_reason).
+
+    Chunks are counted as tokens, which only holds for the stub: moondream
+    streams word-sized chunks and stops itself at settings["max_tokens"], so
+    a stream that ends on its own is re-counted with count_tokens to tell a
+    truncated generation from a finished one.
+    """
+    chunks = []
+    finish_reason = "stop"
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) >= max_tokens:
+                finish_reason = "length"
+                break
+            if time.time() >= deadline:
+                finish_reason = "timeout"
+                break
+            if cancelled is not None and cancelled():
+                record_generation("aborted_disconnect")
+                raise GenerationAborted("disconnect", ''.join(chunks))
+    finally:
+        # Closing the generator stops the decode loop inside the model
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+    text = ''.join(chunks)
+    if finish_reason == "stop" and count_tokens is not None and count_tokens(text) >= max_tokens:
+        finish_reason = "length"
+    return text, finish_reason
+
+
+def run_generation(func, output_key, max_tokens, deadline, cancelled=None, **kwargs):
+    """
+    Run a streaming moondream call once it has been admitted.
+
+    The request's estimated memory is reserved from the admission budget, and
+    models that are not reentrant additionally take the GPU lock. Generation
+    stops cooperatively after max_tokens streamed chunks, when the deadline
+    passes, or when cancelled() reports the client has gone away; the
+    reservation is released as
+    soon as generation stops. Returns (text, finish_reason) where
+    finish_reason is "stop", "length" or "timeout". Raises GenerationAborted
+    if the deadline passes before admission or the client goes away.
+    With BATCH_ENABLED, models that have a step interface run in the
+    experimental shared decode loop instead, with the same budgets.
+    """
+    owner = getattr(func, '__self__', None)
+    if isinstance(owner, RemoteModel):
+        # Admission and generation happen in the inference-owner process
+        return owner.generate(func.__name__, max_tokens, deadline, cancelled, **kwargs)
+
+    if batcher is not None and supports_batching(owner):
+        # The batcher's KV pool takes the place of the admission budget
+        sequence = batcher.submit(owner, func.__name__, max_tokens, deadline, kwargs)
+        with span('model_call'):
+            text, finish_reason = wait_for_sequence(sequence, cancelled)
+    else:
+        cost = admission_cost(kwargs['image'], max_tokens, kwargs.get('length'))
+        exclusive = not getattr(owner, 'reentrant', False)
+        with admitted(cost, deadline, cancelled, exclusive):
+            with span('model_call'):
+                result = func(stream=True, settings={"max_tokens": max_tokens}, **kwargs)
+                text, finish_reason = consume_stream(result[output_key], max_tokens, deadline, cancelled,
+                                                     count_tokens=token_counter(owner))
+
+    record_generation({
+        "stop": "completed",
+        "length": "truncated",
+        "timeout": "aborted_deadline",
+    }[finish_reason])
+    return text, finish_reason
+
+
+def generation_aborted_response(e):
+    """Build the HTTP response for a GenerationAborted error"""
+    if e.reason == "deadline":
+        return jsonify({"error": "Request deadline exceeded before generation started"}), 504
+    # The client is gone; nobody will read this, but Flask needs a response
+    return jsonify({"error": "Client disconnected"}), 499
+
+
+# ============================================================
+# Iteration-level batching
+# ============================================================
+
+class KVBlockPool:
+    """
+    Accounting of fixed-size KV cache blocks shared by all running sequences.
+    A sequence reserves the blocks for its worst case (prompt + max_tokens)
+    when it joins, so it can never run out mid-decode, but takes them from
+    the free list only as it grows. Blocks go straight back to the pool when
+    it leaves. Only ids are handed out; no backend stores its cache in them
+    yet (the stub ignores them), so this bounds admission, not memory.
+    """
+
+    def __init__(self, num_blocks, block_tokens=KV_BLOCK_TOKENS):
+        self.num_blocks = num_blocks
+        self.block_tokens = block_tokens
+        self.free = collections.deque(range(num_blocks))
+        self.reserved = 0
+        self.peak_in_use = 0
+
+    def blocks_for(self, tokens):
+        # A sequence larger than the whole pool runs alone
+        return min(self.num_blocks, math.ceil(tokens / self.block_tokens))
+
+    def try_reserve(self, blocks):
+        if self.reserved + blocks > self.num_blocks:
+            return False
+        self.reserved += blocks
+        return True
+
+    def grow(self, sequence, tokens):
+        """Take blocks from the free list until the sequence can hold tokens"""
+        needed = min(sequence.reserved, math.ceil(tokens / self.block_tokens))
+        while len(sequence.blocks) < needed:
+            sequence.blocks.append(self.free.popleft())
+        self.peak_in_use = max(self.peak_in_use, self.num_blocks - len(self.free))
+
+    def release(self, sequence):
+        self.free.extend(sequence.blocks)
+        sequence.blocks.clear()
+        self.reserved -= sequence.reserved
+        sequence.reserved = 0
+
+    def snapshot(self):
+        return {
+            "blocks": self.num_blocks,
+            "block_tokens": self.block_tokens,
+            "in_use": self.num_blocks - len(self.free),
+            "reserved": self.reserved,
+            "peak_in_use": self.peak_in_use,
+        }
+
+
+class Sequence:
+    """One caption/query request inside the batcher"""
+
+    def __init__(self, model, op, max_tokens, deadline, kwargs):
+        self.model = model
+        self.op = op
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+        self.kwargs = kwargs
+        self.prompt_tokens = IMAGE_TOKENS + PROMPT_TOKENS
+        self.state = None
+        self.blocks = []
+        self.reserved = 0
+        self.tokens = []
+        self.cancelled = False
+        # None while queued or running; "stop", "length", "timeout",
+        # "cancelled", "expired" (deadline passed before joining) or "error"
+        self.finish_reason = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ContinuousBatcher:
+    """
+    Experimental iteration-level scheduler for step-capable models.
+    Each iteration prefills at most one waiting sequence, so a burst of new
+    requests cannot stall the ones already decoding, and then runs one decode
+    step over every running sequence. Sequences join in arrival order when
+    their KV reservation fits the pool and leave as soon as they finish, so a
+    short query never waits for a long caption started before it.
+    """
+
+    def __init__(self, pool, max_running=BATCH_SIZE):
+        self.pool = pool
+        self.max_running = max_running
+        self.waiting = collections.deque()
+        self.running = []
+        self.steps = 0
+        self.peak_running = 0
+        self._cond = threading.Condition()
+        self._started = False
+
+    def submit(self, model, op, max_tokens, deadline, kwargs):
+        sequence = Sequence(model, op, max_tokens, deadline, kwargs)
+        with self._cond:
+            if not self._started:
+                threading.Thread(target=self._loop, name='batcher', daemon=True).start()
+                self._started = True
+            self.waiting.append(sequence)
+            self._cond.notify()
+        return sequence
+
+    def _finish(self, sequence, reason):
+        if sequence.reserved:
+            self.pool.release(sequence)
+        sequence.finish_reason = reason
+        # Drop the model and image so a reloaded model can be freed
+        sequence.model = sequence.state = sequence.kwargs = None
+        sequence.done.set()
+
+    def _next_to_join(self):
+        """Pop the head of the waiting queue if it can join now"""
+        with self._cond:
+            while not self.waiting and not self.running:
+                self._cond.wait()
+            now = time.time()
+            while self.waiting and (self.waiting[0].cancelled or now >= self.waiting[0].deadline):
+                head = self.waiting.popleft()
+                self._finish(head, "cancelled" if head.cancelled else "expired")
+            if not self.waiting or len(self.running) >= self.max_running:
+                return None
+            head = self.waiting[0]
+            # First come first served: a head that does not fit blocks later arrivals
+            if not self.pool.try_reserve(self.pool.blocks_for(head.prompt_tokens + head.max_tokens)):
+                return None
+            head.reserved = self.pool.blocks_for(head.prompt_tokens + head.max_tokens)
+            return self.waiting.popleft()
+
+    def _run(self, model, method, *args, **kwargs):
+        """Call the model under the GPU lock when it is not reentrant"""
+        if getattr(model, 'reentrant', False):
+            return getattr(model, method)(*args, **kwargs)
+        with gpu_lock:
+            return getattr(model, method)(*args, **kwargs)
+
+    def _loop(self):
+        while True:
+            try:
+                self._iterate()
+            except Exception:
+                # Keep scheduling; waiters also give up on their own deadline
+                logger.exception("batcher iteration failed")
+                time.sleep(DISCONNECT_POLL_INTERVAL)
+
+    def _iterate(self):
+        """Join at most one waiting sequence, then run one decode step"""
+        sequence = self._next_to_join()
+        if sequence is not None:
+            try:
+                self.pool.grow(sequence, sequence.prompt_tokens)
+                sequence.state = self._run(sequence.model, 'prefill', sequence.op, sequence.blocks,
+                                           **sequence.kwargs)
+                self.running.append(sequence)
+                self.peak_running = max(self.peak_running, len(self.running))
+            except Exception as e:
+                sequence.error = e
+                self._finish(sequence, "error")
+
+        now = time.time()
+        for s in [s for s in self.running if s.cancelled or now >= s.deadline]:
+            self.running.remove(s)
+            self._finish(s, "cancelled" if s.cancelled else "timeout")
+        if not self.running:
+            return
+
+        # Sequences of a model being replaced by a reload decode separately
+        by_model = collections.defaultdict(list)
+        for s in self.running:
+            by_model[id(s.model)].append(s)
+        self.steps += 1
+        for sequences in by_model.values():
+            for s in sequences:
+                self.pool.grow(s, s.prompt_tokens + len(s.tokens) + 1)
+            try:
+                tokens = self._run(sequences[0].model, 'decode_step', [s.state for s in sequences])
+            except Exception as e:
+                for s in sequences:
+                    self.running.remove(s)
+                    s.error = e
+                    self._finish(s, "error")
+                continue
+            for s, token in zip(sequences, tokens):
+                if token is not None:
+                    s.tokens.append(token)
+                if token is None or len(s.tokens) >= s.max_tokens:
+                    self.running.remove(s)
+                    self._finish(s, "stop" if token is None else "length")
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "running": len(self.running),
+                "waiting": len(self.waiting),
+                "peak_running": self.peak_running,
+                "max_running": self.max_running,
+                "steps": self.steps,
+                "kv_pool": self.pool.snapshot(),
+            }
+
+
+def kv_pool_blocks():
+    """KV_POOL_BLOCKS, or a pool sized from the memory budget or BATCH_SIZE"""
+    if KV_POOL_BLOCKS > 0:
+        return KV_POOL_BLOCKS
+    if GPU_MEMORY_BUDGET_MB > 0:
+        return max(1, int((GPU_MEMORY_BUDGET_MB - COST_BASE_MB) / (KV_BLOCK_TOKENS * COST_PER_TOKEN_MB)))
+    return BATCH_SIZE * math.ceil((IMAGE_TOKENS + PROMPT_TOKENS + MAX_TOKENS_LIMIT) / KV_BLOCK_TOKENS)
+
+
+batcher = ContinuousBatcher(KVBlockPool(kv_pool_blocks())) if BATCH_ENABLED else None
+
+
+def supports_batching(model):
+    """
+    Whether the scheduler can drive a model. The moondream remote code keeps
+    one KV cache on the module and exposes no prefill / decode_step, so its
+    requests take the admission path even with BATCH_ENABLED.
+    """
+    return hasattr(model, 'prefill') and hasattr(model, 'decode_step')
+
+
+def wait_for_sequence(sequence, cancelled=None):
+    """
+    Wait for a batched sequence to finish. Returns (text, finish_reason) like
+    consume_stream; raises GenerationAborted if the deadline passed before it
+    joined or the client went away.
+    """
+    while not sequence.done.wait(DISCONNECT_POLL_INTERVAL):
+        if cancelled is not None and cancelled():
+            # The batcher drops it, and frees its KV blocks, at the next step
+            sequence.cancelled = True
+            record_generation("aborted_disconnect")
+            raise GenerationAborted("disconnect", ''.join(sequence.tokens))
+        if time.time() >= sequence.deadline + INFERENCE_GRACE:
+            # The batcher finishes sequences at their deadline; if it has not,
+            # its loop is stuck and nobody else will end this wait
+            sequence.cancelled = True
+            logger.error("batcher missed a sequence deadline", extra={"fields": {
+                "running": len(batcher.running) if batcher is not None else None,
+            }})
+            record_generation("aborted_deadline")
+            raise GenerationAborted("deadline", ''.join(sequence.tokens))
+    if sequence.finish_reason == "expired":
+        record_generation("aborted_deadline")
+        raise GenerationAborted("deadline")
+    if sequence.finish_reason == "error":
+        raise sequence.error
+    return ''.join(sequence.tokens), sequence.finish_reason
+
+
+# ============================================================
+# Structured logging
+# ============================================================
+
+def _original(module, name, default):
+    """Return the unpatched stdlib callable when running under gevent"""
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except ImportError:
+        return default
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        # Fields never replace the keys above
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            entry.setdefault(key, value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a configured fraction of records per level"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+def parse_sample_rates(spec):
+    """Parse "debug=0.01,info=1" into {logging.DEBUG: 0.01, logging.INFO: 1.0}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        level, _, rate = item.partition('=')
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Hand records to a background writer instead of writing on the request path.
+    The writer is a real OS thread, so under gevent a slow stdout never blocks
+    the event loop. When the buffer is full new records are dropped and counted.
+    """
+
+    def __init__(self, stream, maxsize=LOG_QUEUE_SIZE, interval=LOG_FLUSH_INTERVAL):
+        super().__init__()
+        self.stream = stream
+        self.maxsize = maxsize
+        self.interval = interval
+        self.dropped = 0
+        self._records = collections.deque()
+        self._sleep = _original('time', 'sleep', time.sleep)
+        self._write_lock = _thread.allocate_lock()
+        _original('_thread', 'start_new_thread', _thread.start_new_thread)(self._run, ())
+        atexit.register(self.drain)
+
+    def emit(self, record):
+        if len(self._records) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._records.append(record)
+
+    def drain(self):
+        """Write out every buffered record"""
+        with self._write_lock:
+            lines = []
+            while self._records:
+                record = self._records.popleft()
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+
+    def _run(self):
+        while True:
+            self._sleep(self.interval)
+            try:
+                self.drain()
+            except Exception:
+                pass
+
+
+def setup_logging():
+    """Configure the "moondream" logger: JSON lines, sampled, written in the background"""
+    log = logging.getLogger('moondream')
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    handler = AsyncLogHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    log.addHandler(handler)
+    # Filter on the logger so dropped records never reach the handler
+    log.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    return log
+
+
+logger = setup_logging()
+
+
+def new_request_id(kind):
+    """Generate a request id such as query_2025-01-29-18:30:00-abc123"""
+    return f"{kind}_{datetime.now().strftime('%Y-%m-%d-%H:%M:%S')}-{uuid.uuid4().hex[:6]}"
+
+
+# ============================================================
+# Profiling
+# ============================================================
+
+# Chrome trace process ids for the three kinds of events we collect
+TRACE_PID_SPANS = 1
+TRACE_PID_SAMPLES = 2
+TRACE_PID_TORCH = 3
+# Name of the marker event that ties the torch.profiler clock to ours
+TORCH_CLOCK_ANCHOR = 'moondream_clock_anchor'
+
+# The running Profile, or None. Only one profile runs at a time.
+active_profile = None
+profile_lock = threading.Lock()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add_span(self.name, self.start, time.perf_counter())
+        return False
+
+
+def span(name):
+    """
+    Time a section of the request path for the active profile.
+    Returns a shared no-op context manager when no profile is running.
+    """
+    profile = active_profile
+    if profile is None:
+        return _NULL_SPAN
+    return _Span(profile, name)
+
+
+class Profile:
+    """
+    Collects request spans and sampled Python stacks as Chrome trace events.
+    Sampling runs on a real OS thread so it keeps running while the gevent
+    hub is busy. Under gevent every request is a greenlet on one OS thread and
+    sys._current_frames() only shows the one running right now, so parked
+    greenlets are sampled from their gr_frame: greenlets alive at start are
+    found once via gc, later ones through greenlet.settrace.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.origin = time.perf_counter()
+        self.events = []
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = False
+        self._done = _thread.allocate_lock()
+        self._sleep = _original('time', 'sleep', time.sleep)
+        # id -> weakref of every greenlet seen; a real lock, since the
+        # sampler thread and the greenlets' thread both use it
+        self._greenlets = {}
+        self._greenlets_lock = _original('_thread', 'allocate_lock', _thread.allocate_lock)()
+        self._own_greenlet = None
+        self._tracing = False
+        self._previous_trace = None
+
+    def _ts(self, t):
+        return round((t - self.origin) * 1e6, 1)
+
+    def add_span(self, name, start, end):
+        event = {
+            "name": name, "cat": "span", "ph": "X",
+            "ts": self._ts(start), "dur": round((end - start) * 1e6, 1),
+            "pid": TRACE_PID_SPANS, "tid": threading.get_ident(),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def _stack(self, frame):
+        names = []
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.reverse()
+        return names
+
+    def _track(self, glet):
+        with self._greenlets_lock:
+            self._greenlets[id(glet)] = weakref.ref(glet)
+
+    def _on_switch(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            self._track(origin)
+            self._track(target)
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _parked_frames(self):
+        """{greenlet id: frame} of the greenlets that are alive and not running"""
+        with self._greenlets_lock:
+            refs = list(self._greenlets.items())
+        frames = {}
+        for key, ref in refs:
+            glet = ref()
+            if glet is None or glet.dead:
+                with self._greenlets_lock:
+                    if self._greenlets.get(key) is ref:
+                        del self._greenlets[key]
+                continue
+            # Running greenlets have no gr_frame; sys._current_frames() covers them
+            frame = glet.gr_frame
+            if frame is not None and glet is not self._own_greenlet:
+                frames[key] = frame
+        return frames
+
+    def _sample_loop(self):
+        own = _thread.get_ident()
+        open_stacks = {}
+        try:
+            while not self._stop:
+                ts = self._ts(time.perf_counter())
+                frames = sys._current_frames()
+                if self._tracing:
+                    frames.update(self._parked_frames())
+                events = []
+                for tid, frame in frames.items():
+                    if tid == own:
+                        continue
+                    stack = self._stack(frame)
+                    previous = open_stacks.get(tid, [])
+                    common = 0
+                    while common < min(len(stack), len(previous)) and stack[common] == previous[common]:
+                        common += 1
+                    for name in reversed(previous[common:]):
+                        events.append({"name": name, "ph": "E", "ts": ts, "pid": TRACE_PID_SAMPLES, "tid": tid})
+                    for name in stack[common:]:
+                        events.append({"name": name, "cat": "sample", "ph": "B", "ts": ts, "pid": TRACE_PID_SAMPLES, "tid": tid})
+                    open_stacks[tid] = stack
+                for tid in list(open_stacks):
+                    if tid not in frames:
+                        for name in reversed(open_stacks.pop(tid)):
+                            events.append({"name": name, "ph": "E", "ts": ts, "pid": TRACE_PID_SAMPLES, "tid": tid})
+                del frames
+                with self._lock:
+                    self.events.extend(events)
+                self.samples += 1
+                self._sleep(self.interval)
+        finally:
+            ts = self._ts(time.perf_counter())
+            with self._lock:
+                for tid, stack in open_stacks.items():
+                    for name in reversed(stack):
+                        self.events.append({"name": name, "ph": "E", "ts": ts, "pid": TRACE_PID_SAMPLES, "tid": tid})
+            self._done.release()
+
+    def start(self):
+        if greenlet is not None:
+            self._own_greenlet = greenlet.getcurrent()
+            for obj in gc.get_objects():
+                if isinstance(obj, greenlet.greenlet):
+                    self._track(obj)
+            self._previous_trace = greenlet.settrace(self._on_switch)
+            self._tracing = True
+        self._done.acquire()
+        _original('_thread', 'start_new_thread', _thread.start_new_thread)(self._sample_loop, ())
+
+    def stop(self):
+        """Stop sampling; call from the greenlet/thread that called start()"""
+        self._stop = True
+        self._done.acquire()
+        self._done.release()
+        if self._tracing:
+            greenlet.settrace(self._previous_trace)
+            self._tracing = False
+
+    def trace(self, torch_events=()):
+        """Return the collected events as a Chrome trace document"""
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+            for pid, name in (
+                (TRACE_PID_SPANS, "request spans"),
+                (TRACE_PID_SAMPLES, "python samples"),
+                (TRACE_PID_TORCH, "torch operators"),
+            )
+        ]
+        with self._lock:
+            events = metadata + self.events + list(torch_events)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"samples": self.samples, "sample_interval": self.interval},
+        }
+
+
+def start_torch_profiler():
+    """
+    Start torch.profiler if it is usable here. Returns (profiler, anchor) or
+    None, where anchor is the perf_counter() time of a marker event recorded
+    in the torch trace: torch timestamps are on the profiler's own clock.
+    """
+    try:
+        from torch.profiler import profile, record_function, ProfilerActivity
+    except ImportError:
+        return None
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    prof = profile(activities=activities)
+    prof.start()
+    before = time.perf_counter()
+    with record_function(TORCH_CLOCK_ANCHOR):
+        pass
+    anchor = (before + time.perf_counter()) / 2
+    return prof, anchor
+
+
+def stop_torch_profiler(torch_profile, origin):
+    """
+    Stop torch.profiler and return its trace events on the Profile's clock
+    (microseconds since origin, a perf_counter() time), moved to their own
+    process track
+    """
+    if torch_profile is None:
+        return []
+    prof, anchor = torch_profile
+    prof.stop()
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        prof.export_chrome_trace(f.name)
+        with open(f.name) as trace_file:
+            events = json.load(trace_file).get('traceEvents', [])
+
+    marker = next((e for e in events if e.get('name') == TORCH_CLOCK_ANCHOR and 'ts' in e), None)
+    if marker is None:
+        logger.warning("torch trace has no clock anchor; leaving out torch events")
+        return []
+    # The anchor time is the middle of the marker event
+    offset = (anchor - origin) * 1e6 - (marker['ts'] + marker.get('dur', 0) / 2)
+    rebased = []
+    for event in events:
+        if event is marker:
+            continue
+        # Metadata events carry a timestamp too, but it is not a point in the trace
+        if event.get('ph') != 'M' and isinstance(event.get('ts'), (int, float)):
+            event['ts'] = round(event['ts'] + offset, 1)
+        event['pid'] = TRACE_PID_TORCH
+        rebased.append(event)
+    return rebased
+
+
+def decode_image_bytes(image_bytes):
+    """Decode encoded image bytes (JPEG, PNG, ...) into an RGB PIL Image"""
+    with span('pil_decode'):
         # Open the image from bytes
         image = Image.open(io.BytesIO(image_bytes))
         # Force loading image data to catch errors early
@@ -127,7 +1425,17 @@ def decode_base64_image(image_url):
         if image.mode != 'RGB':
             image = image.convert('RGB')
 
-        return image
+    return image
+
+def decode_base64_image(image_url):
+    """Decode base64 image from data URL"""
+    if image_url.startswith('data:image/'):
+        # Extract the base64 part after the comma
+        header, encoded = image_url.split(',', 1)
+        with span('base64_decode'):
+            image_bytes = base64.b64decode(encoded, validate=True)
+
+        return decode_image_bytes(image_bytes)
     else:
         raise ValueError("Invalid image_url format. Expected data URL format: data:image/<type>;base64,<data>")
 
@@ -145,18 +1453,56 @@ def calculate_metrics(start_time, end_time, input_tokens=0, output_tokens=0):
         "ttft_ms": round(ttft, 2)
     }
 
+def model_name(model_id):
+    """Short model name for /health: the last part of a Hub id or local path"""
+    return model_id.rstrip('/').rsplit('/', 1)[-1] if model_id else model_id
+
+
+def inference_status():
+    """Model, admission, generation and image registry state of the process that runs inference"""
+    return {
+        # "model" keeps its original form (e.g. "moondream-2b-2025-04-14");
+        # model_id is the full Hub id or path that was loaded
+        "model": model_name(active_model["model_id"]),
+        "model_id": active_model["model_id"],
+        "revision": active_model["revision"],
+        "model_loaded_at": active_model["loaded_at"],
+        "model_load_seconds": active_model["load_seconds"],
+        "peak_rss_mb": peak_rss_mb(),
+        "reload_status": reload_state["status"],
+        "batching": batcher.snapshot() if batcher is not None else None,
+        "image_store": image_store.stats(),
+        "model_backend": MODEL_BACKEND,
+        "admission": admission.snapshot(),
+        "generation": {
+            "default_max_tokens": DEFAULT_MAX_TOKENS,
+            "max_tokens_limit": MAX_TOKENS_LIMIT,
+            "request_deadline": REQUEST_DEADLINE,
+            "stats": dict(generation_stats),
+        }
+    }
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    if INFERENCE_MODE == 'client':
+        try:
+            status = moondream.call({"op": "status"}, time.time() + DISCONNECT_POLL_INTERVAL * 4)
+        except Exception as e:
+            return jsonify({"status": "error", "error": f"Inference owner unavailable: {e}"}), 503
+    else:
+        status = inference_status()
+
     return jsonify({
         "status": "ok",
-        "model": "moondream-2b-2025-04-14",
+        **status,
+        "inference_mode": INFERENCE_MODE,
         "api_key_enabled": bool(VLM_API_KEY),
         "optimization": {
             "preprocess_workers": PREPROCESS_WORKERS,
             "batch_enabled": BATCH_ENABLED,
             "batch_size": BATCH_SIZE if BATCH_ENABLED else None
-        }
+        },
     })
 
 @app.route('/', methods=['GET'])
@@ -618,35 +1964,48 @@ def v1_caption():
 
     Expects JSON body:
     - image_url: base64 data URL (e.g., "data:image/jpeg;base64,...")
+    - image_id: id returned by /v1/images, in place of image_url
     - length: caption length - "short", "normal", or "long" (default: "normal")
     - stream: boolean for streaming (default: false, not yet implemented)
+    - max_tokens: maximum number of tokens to generate (optional)
+    - timeout: seconds before generation is abandoned, capped by REQUEST_DEADLINE (optional)
     """
+    request_start = time.time()
     try:
-        data = request.get_json()
+        with span('json_parse'):
+            data = request.get_json()
         if not data:
             return jsonify({"error": "Invalid JSON body"}), 400
 
-        image_url = data.get('image_url')
-        if not image_url:
-            return jsonify({"error": "Missing image_url parameter"}), 400
+        if not data.get('image_url') and not data.get('image_id'):
+            return jsonify({"error": "Missing image_url or image_id parameter"}), 400
 
         length = data.get('length', 'normal')
         if length not in ['short', 'normal', 'long']:
             length = 'normal'
 
         stream = data.get('stream', False)
+        max_tokens, deadline = parse_generation_budget(data, request_start)
+        cancelled = disconnect_watcher()
 
-        # Async preprocess: submit to thread pool (non-blocking for other requests)
-        preprocess_future = preprocess_image_async(image_url)
-        
-        # Wait for preprocessing to complete
-        image = preprocess_future.result()
+        # Generate request_id
+        request_id = new_request_id('caption')
+
+        image = load_request_image(data)
 
         # Start timing (inference only)
         start_time = time.time()
 
         # Generate caption with GPU lock (prevents concurrent GPU access)
-        result = run_inference_with_lock(moondream.caption, image, length=length)
+        caption, finish_reason = run_generation(
+            moondream.caption,
+            "caption",
+            max_tokens,
+            deadline,
+            cancelled=cancelled,
+            image=image,
+            length=length,
+        )
 
         # End timing
         end_time = time.time()
@@ -657,24 +2016,30 @@ def v1_caption():
             [start_time],
             [end_time],
             input_tokens=735,  # Estimated
-            output_tokens=len(result["caption"].split())
+            output_tokens=len(caption.split())
         )
 
         response = {
-            "caption": result["caption"],
+            "request_id": request_id,
+            "caption": caption,
             "metrics": metrics,
-            "finish_reason": "stop"
+            "finish_reason": finish_reason
         }
 
-        # Print timing to console
-        print(f"\n{'='*60}")
-        print(f"[v1 API] Inference Time: {inference_time:.3f} seconds")
-        print(f"[v1 API] Caption Length: {length}")
-        print(f"[v1 API] Caption: {result['caption']}")
-        print(f"{'='*60}\n")
+        logger.info("caption complete", extra={"request_id": request_id, "fields": {
+            "inference_time_ms": round(inference_time * 1000, 2),
+            "length": length,
+            "finish_reason": finish_reason,
+            "output_chars": len(caption),
+        }})
+        logger.debug("caption text", extra={"request_id": request_id, "fields": {"caption": caption}})
 
         return jsonify(response)
 
+    except GenerationAborted as e:
+        return generation_aborted_response(e)
+    except ImageNotFound as e:
+        return jsonify({"error": str(e)}), 404
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -689,41 +2054,49 @@ def v1_query():
 
     Expects JSON body:
     - image_url: base64 data URL (e.g., "data:image/jpeg;base64,...")
+    - image_id: id returned by /v1/images, in place of image_url
     - question: question about the image
+    - max_tokens: maximum number of tokens to generate (optional)
+    - timeout: seconds before generation is abandoned, capped by REQUEST_DEADLINE (optional)
     """
+    request_start = time.time()
     try:
-        data = request.get_json()
+        with span('json_parse'):
+            data = request.get_json()
         if not data:
             return jsonify({"error": "Invalid JSON body"}), 400
 
-        image_url = data.get('image_url')
-        if not image_url:
-            return jsonify({"error": "Missing image_url parameter"}), 400
+        if not data.get('image_url') and not data.get('image_id'):
+            return jsonify({"error": "Missing image_url or image_id parameter"}), 400
 
         question = data.get('question')
         if not question:
             return jsonify({"error": "Missing question parameter"}), 400
 
+        max_tokens, deadline = parse_generation_budget(data, request_start)
+        cancelled = disconnect_watcher()
+
         # Generate request_id
-        request_id = f"query_{datetime.now().strftime('%Y-%m-%d-%H:%M:%S')}-{uuid.uuid4().hex[:6]}"
+        request_id = new_request_id('query')
 
-        # Async preprocess: submit to thread pool (non-blocking for other requests)
-        print(f"[DEBUG] Submitting image preprocessing (length: {len(image_url)})")
-        preprocess_future = preprocess_image_async(image_url)
-        
-        # Wait for preprocessing to complete
-        image = preprocess_future.result()
-        print(f"[DEBUG] Image preprocessed: size={image.size}, mode={image.mode}")
+        image = load_request_image(data)
+        logger.debug("image loaded", extra={"request_id": request_id, "fields": {
+            "image_id": data.get('image_id'),
+            "image_url_length": len(data.get('image_url') or ''),
+        }})
 
         # Start timing (inference only)
         start_time = time.time()
 
         # Run inference with GPU lock (prevents concurrent GPU access)
-        print(f"[DEBUG] Calling moondream.query with question: {question}")
-        result = run_inference_with_lock(
+        answer, finish_reason = run_generation(
             moondream.query,
+            "answer",
+            max_tokens,
+            deadline,
+            cancelled=cancelled,
             image=image,
-            question=question
+            question=question,
         )
 
         # End timing
@@ -732,30 +2105,1243 @@ def v1_query():
 
         response = {
             "request_id": request_id,
-            "answer": result["answer"]
+            "answer": answer,
+            "finish_reason": finish_reason
         }
 
-        # Print timing to console
-        print(f"\n{'='*60}")
-        print(f"[v1 API] Request ID: {request_id}")
-        print(f"[v1 API] Inference Time: {inference_time:.3f} seconds")
-        print(f"[v1 API] Question: {question}")
-        print(f"[v1 API] Answer: {result['answer']}")
-        print(f"{'='*60}\n")
+        logger.info("query complete", extra={"request_id": request_id, "fields": {
+            "inference_time_ms": round(inference_time * 1000, 2),
+            "finish_reason": finish_reason,
+            "question_chars": len(question),
+            "output_chars": len(answer),
+        }})
+        logger.debug("query text", extra={"request_id": request_id, "fields": {
+            "question": question,
+            "answer": answer,
+        }})
 
         return jsonify(response)
 
+    except GenerationAborted as e:
+        return generation_aborted_response(e)
+    except ImageNotFound as e:
+        return jsonify({"error": str(e)}), 404
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/debug/profile', methods=['GET'])
+@admin_key_required
+def debug_profile():
+    """
+    Record a profile of the server for ?seconds=N (default 10) and return it
+    as a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev).
+
+    The trace contains request spans (json_parse, base64_decode, pil_decode,
+    lock_wait, model_call), sampled Python stacks of every thread and greenlet
+    and, when torch is available, torch.profiler operator timings.
+
+    An admin endpoint (X-Moondream-Admin-Auth): the trace exposes request
+    internals, and the inference key is handed to every client.
+    """
+    global active_profile
+    if not PROFILING_ENABLED:
+        return jsonify({"error": "Profiling is disabled (set PROFILING_ENABLED=true)"}), 404
+
+    try:
+        seconds = float(request.args.get('seconds', '10'))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        profile = Profile()
+        torch_prof = start_torch_profiler()
+        profile.start()
+        active_profile = profile
+        try:
+            time.sleep(seconds)
+        finally:
+            active_profile = None
+            profile.stop()
+            torch_events = stop_torch_profiler(torch_prof, profile.origin)
+        trace = profile.trace(torch_events)
+    finally:
+        profile_lock.release()
+
+    response = app.response_class(json.dumps(trace), mimetype='application/json')
+    filename = f"moondream-profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+# ============================================================
+# Image registry
+# ============================================================
+
+class ImageStore:
+    """
+    Bounded store of uploaded images with a TTL.
+
+    The most recently used images stay in memory, up to max_items images and
+    max_bytes of decoded RGB (the newest few together with their model
+    encoding); older ones spill to raw RGB files in a local
+    directory and are promoted back on access. Each process spills into its
+    own subdirectory, which is removed at exit.
+    """
+
+    def __init__(self, directory, max_items, max_bytes, max_encoded, max_disk_items, ttl):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_encoded = max_encoded
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        # image_id -> [image, encoded, expires_at], least recently used first
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        # image_id -> (size, expires_at), oldest first
+        self._disk = collections.OrderedDict()
+        self._lock = threading.Lock()
+        atexit.register(self._cleanup)
+
+    def _process_dir(self):
+        # Resolved per call: gunicorn --preload forks workers after import
+        return os.path.join(self.directory, str(os.getpid()))
+
+    def _path(self, image_id):
+        return os.path.join(self._process_dir(), f"{image_id}.rgb")
+
+    def _cleanup(self):
+        shutil.rmtree(self._process_dir(), ignore_errors=True)
+
+    def _remove_file(self, image_id):
+        try:
+            os.remove(self._path(image_id))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _image_bytes(image):
+        return image.width * image.height * 3
+
+    def _add_to_memory(self, image_id, image, encoded, expires_at):
+        self._memory[image_id] = [image, encoded, expires_at]
+        self._memory_bytes += self._image_bytes(image)
+
+    def _pop_from_memory(self, image_id=None):
+        """Remove image_id (default: the least recently used) from memory"""
+        if image_id is None:
+            image_id, entry = self._memory.popitem(last=False)
+        else:
+            entry = self._memory.pop(image_id)
+        self._memory_bytes -= self._image_bytes(entry[0])
+        return image_id, entry
+
+    def _memory_full(self):
+        if len(self._memory) > self.max_items:
+            return True
+        # The newest image stays in memory even if it alone is over the budget
+        return self._memory_bytes > self.max_bytes and len(self._memory) > 1
+
+    def _purge_expired(self, now):
+        for image_id in [i for i, e in self._memory.items() if e[2] <= now]:
+            self._pop_from_memory(image_id)
+        for image_id in [i for i, e in self._disk.items() if e[1] <= now]:
+            del self._disk[image_id]
+            self._remove_file(image_id)
+
+    def _enforce_limits(self):
+        # Drop encodings beyond the most recent max_encoded entries
+        with_encoding = [e for e in self._memory.values() if e[1] is not None]
+        for entry in with_encoding[:max(0, len(with_encoding) - self.max_encoded)]:
+            entry[1] = None
+
+        # Spill least recently used images to disk
+        if self._memory_full():
+            os.makedirs(self._process_dir(), exist_ok=True)
+        while self._memory_full():
+            image_id, (image, _, expires_at) = self._pop_from_memory()
+            with open(self._path(image_id), 'wb') as f:
+                f.write(image.tobytes())
+            self._disk[image_id] = (image.size, expires_at)
+
+        while len(self._disk) > self.max_disk_items:
+            image_id, _ = self._disk.popitem(last=False)
+            self._remove_file(image_id)
+
+    def put(self, image, encoded=None):
+        """Store an RGB image (and optional encoding); returns (image_id, expires_at)"""
+        image_id = f"img_{uuid.uuid4().hex}"
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._purge_expired(time.time())
+            self._add_to_memory(image_id, image, encoded, expires_at)
+            self._enforce_limits()
+        return image_id, expires_at
+
+    def get(self, image_id):
+        """Return (image, encoded) for image_id, or None if unknown or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(image_id)
+            if entry is not None:
+                if entry[2] <= now:
+                    self._pop_from_memory(image_id)
+                    return None
+                self._memory.move_to_end(image_id)
+                return entry[0], entry[1]
+
+            disk_entry = self._disk.pop(image_id, None)
+            if disk_entry is None:
+                return None
+            size, expires_at = disk_entry
+            path = self._path(image_id)
+            if expires_at <= now:
+                self._remove_file(image_id)
+                return None
+            with open(path, 'rb') as f:
+                image = Image.frombytes('RGB', size, f.read())
+            self._remove_file(image_id)
+            self._add_to_memory(image_id, image, None, expires_at)
+            self._enforce_limits()
+            return image, None
+
+    def drop_encodings(self):
+        """Forget all stored encodings (after the model they came from is replaced)"""
+        with self._lock:
+            for entry in self._memory.values():
+                entry[1] = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory": len(self._memory),
+                "memory_mb": round(self._memory_bytes / (1024 * 1024), 1),
+                "encoded": sum(1 for e in self._memory.values() if e[1] is not None),
+                "disk": len(self._disk),
+                "ttl": self.ttl,
+            }
+
+
+image_store = ImageStore(
+    IMAGE_STORE_DIR,
+    IMAGE_STORE_MAX_ITEMS,
+    int(IMAGE_STORE_MAX_MB * 1024 * 1024),
+    IMAGE_STORE_MAX_ENCODED,
+    IMAGE_STORE_DISK_ITEMS,
+    IMAGE_STORE_TTL,
+)
+
+
+def encode_image(image, deadline, cancelled=None):
+    """
+    Run the model's vision encoder on an image, if the model supports it.
+    Returns the encoding, or None when the model has no encode_image.
+    """
+    encode = getattr(moondream, 'encode_image', None)
+    if encode is None:
+        return None
+    cost = admission_cost(image, 0)
+    with admitted(cost, deadline, cancelled, not getattr(moondream, 'reentrant', False)):
+        with span('model_call'):
+            return encode(image)
+
+
+def store_image(image, encode, deadline, cancelled=None):
+    """
+    Register an image, and its encoding if requested, in the registry of the
+    process that runs inference. Returns (image_id, expires_at, encoded).
+    """
+    if INFERENCE_MODE == 'client':
+        return moondream.store_image(image, encode, deadline, cancelled)
+    encoded = encode_image(image, deadline, cancelled) if encode else None
+    image_id, expires_at = image_store.put(image, encoded)
+    return image_id, expires_at, encoded is not None
+
+
+@app.route('/v1/images', methods=['POST'])
+@api_key_required
+def v1_upload_image():
+    """
+    Store an image once and reference it by image_id in later calls
+
+    Expects JSON body:
+    - image_url: base64 data URL (e.g., "data:image/jpeg;base64,...")
+    - encode: also store the model's image encoding (default: true)
+
+    Returns the image_id and its expiry time. /v1/caption and /v1/query
+    accept image_id in place of image_url.
+    """
+    request_start = time.time()
+    try:
+        with span('json_parse'):
+            data = request.get_json()
+        if not data:
+            return jsonify({"error": "Invalid JSON body"}), 400
+
+        image_url = data.get('image_url')
+        if not image_url:
+            return jsonify({"error": "Missing image_url parameter"}), 400
+
+        image = preprocess_image_async(image_url).result()
+        image_id, expires_at, encoded = store_image(
+            image, data.get('encode', True), request_start + REQUEST_DEADLINE, disconnect_watcher())
+        logger.info("image stored", extra={"request_id": image_id, "fields": {
+            "size": image.size,
+            "encoded": encoded,
+        }})
+
+        return jsonify({
+            "image_id": image_id,
+            "expires_at": expires_at,
+            "width": image.width,
+            "height": image.height,
+            "encoded": encoded,
+        }), 201
+
+    except GenerationAborted as e:
+        return generation_aborted_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ============================================================
+# WebSocket frame streams
+# ============================================================
+
+class FrameStream:
+    """
+    State of one streaming session: the standing task and a one-frame mailbox.
+    A frame that arrives while the previous one is still waiting replaces it,
+    so the backlog never exceeds one frame.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.task = None
+        self.frame = None
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        # The receive loop and the inference worker both reply on the socket;
+        # a WebSocket connection is not safe for concurrent writers
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        """Send a JSON message to the client, one writer at a time"""
+        data = json.dumps(message)
+        with self._send_lock:
+            self.ws.send(data)
+
+    def configure(self, message):
+        """Set the standing task from a JSON control message"""
+        task = {"max_tokens": parse_max_tokens(message)}
+        if message.get('question'):
+            task["question"] = message['question']
+        else:
+            length = message.get('length', 'short')
+            task["length"] = length if length in ['short', 'normal', 'long'] else 'short'
+        with self._cond:
+            self.task = task
+            self._cond.notify_all()
+        return task
+
+    def push(self, data):
+        """Store the newest frame, dropping the one still waiting (if any)"""
+        with self._cond:
+            self.received += 1
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = (self.received, data, time.time())
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def next(self):
+        """Wait for a frame and a task; returns (seq, data, received_at, task) or None when closed"""
+        with self._cond:
+            while not self.closed and (self.frame is None or self.task is None):
+                self._cond.wait()
+            if self.closed:
+                return None
+            seq, data, received_at = self.frame
+            self.frame = None
+            return seq, data, received_at, self.task
+
+
+def read_auth_message(ws):
+    """
+    Read the key from a first message {"type": "auth", "api_key": "..."}.
+    Browsers cannot set headers on a WebSocket, and a key in the URL would
+    end up in the access log. Returns '' if the message is missing or malformed.
+    """
+    try:
+        message = json.loads(ws.receive(timeout=STREAM_AUTH_TIMEOUT) or '{}')
+    except (ValueError, TypeError):
+        return ''
+    if isinstance(message, dict) and message.get('type') == 'auth':
+        return str(message.get('api_key', ''))
+    return ''
+
+
+def answer_frames(stream):
+    """Run inference on the newest frame of a stream until it closes"""
+    while True:
+        item = stream.next()
+        if item is None:
+            return
+        seq, data, received_at, task = item
+        try:
+            image = preprocess_pool.submit(decode_image_bytes, data).result()
+            deadline = time.time() + STREAM_FRAME_TIMEOUT
+            # Only a closed session cancels; newer frames wait for this answer
+            cancelled = lambda: stream.closed
+            if "question" in task:
+                key = "answer"
+                text, finish_reason = run_generation(
+                    moondream.query, key, task['max_tokens'], deadline,
+                    cancelled=cancelled, image=image, question=task['question'],
+                )
+            else:
+                key = "caption"
+                text, finish_reason = run_generation(
+                    moondream.caption, key, task['max_tokens'], deadline,
+                    cancelled=cancelled, image=image, length=task['length'],
+                )
+            message = {
+                "type": "result",
+                "frame": seq,
+                key: text,
+                "finish_reason": finish_reason,
+                "latency_ms": round((time.time() - received_at) * 1000, 2),
+                "dropped": stream.dropped,
+            }
+        except GenerationAborted as e:
+            if e.reason == "disconnect":
+                return
+            message = {"type": "error", "frame": seq, "error": "Frame deadline exceeded"}
+        except Exception as e:
+            message = {"type": "error", "frame": seq, "error": str(e)}
+        try:
+            stream.send(message)
+        except ConnectionClosed:
+            return
+
+
+if websocket is not None:
+    @websocket.route('/v1/stream')
+    def v1_stream(ws):
+        """
+        Persistent WebSocket session for continuous camera frames
+
+        Authenticate with the X-Moondream-Auth header, or (browsers) with a
+        first message {"type": "auth", "api_key": "..."}. Send a JSON text message to set the standing task:
+        {"question": "...", "max_tokens": 64} or {"length": "short"} for
+        captions; send it again at any time to change it. Send each frame as
+        a binary message with the encoded image. Results come back as JSON
+        text messages. Frames that arrive while inference is busy replace the
+        pending frame instead of queueing behind it.
+        """
+        api_key = request.headers.get('X-Moondream-Auth')
+        if api_key is None and VLM_API_KEY:
+            api_key = read_auth_message(ws)
+        if not api_key_valid(api_key):
+            ws.close(reason=1008, message="Invalid or missing API key")
+            return
+
+        request_id = new_request_id('stream')
+        stream = FrameStream(ws)
+        worker = threading.Thread(target=answer_frames, args=(stream,), daemon=True)
+        worker.start()
+        logger.info("stream opened", extra={"request_id": request_id})
+        try:
+            while True:
+                message = ws.receive()
+                if isinstance(message, bytes):
+                    stream.push(message)
+                    continue
+                try:
+                    task = stream.configure(json.loads(message))
+                    stream.send({"type": "ready", "request_id": request_id, "task": task})
+                except (ValueError, AttributeError) as e:
+                    stream.send({"type": "error", "error": str(e) or "Invalid control message"})
+        except ConnectionClosed:
+            pass
+        finally:
+            stream.close()
+            worker.join()
+            logger.info("stream closed", extra={"request_id": request_id, "fields": {
+                "frames": stream.received,
+                "dropped": stream.dropped,
+            }})
+
+
+# ============================================================
+# Model reload
+# ============================================================
+
+active_model = {"model_id": None, "revision": None, "loaded_at": None, "load_seconds": None}
+reload_state = {"status": "idle"}
+reload_lock = threading.Lock()
+
+
+def set_active_model(model_id, revision, load_seconds=None):
+    active_model.update(model_id=model_id, revision=revision, loaded_at=time.time(),
+                        load_seconds=round(load_seconds, 2) if load_seconds is not None else None)
+
+
+def wait_for_release(retired):
+    """
+    Wait until the weakly referenced previous model has been dropped by every
+    in-flight request, then return its cached GPU memory to the driver.
+    """
+    end = time.time() + MODEL_RELEASE_TIMEOUT
+    while retired() is not None and time.time() < end:
+        gc.collect()
+        time.sleep(1.0)
+    if retired() is not None:
+        logger.warning("previous model still referenced after release timeout")
+        return
+    if MODEL_BACKEND != 'stub' and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    logger.info("previous model released")
+
+
+def reload_model(model_id, revision):
+    """
+    Load and warm up a model in the background, then swap it in.
+    Requests that already picked up the previous model finish on it; it is
+    freed once the last of them is done.
+    """
+    global moondream
+    try:
+        logger.info("model reload started", extra={"fields": {"model_id": model_id, "revision": revision}})
+        start = time.perf_counter()
+        model = build_model(model_id, revision)
+        load_seconds = time.perf_counter() - start
+        if BATCH_ENABLED and not supports_batching(model):
+            logger.warning("BATCH_ENABLED is ignored for this model (no prefill/decode_step)")
+        warm_up(model)
+
+        retired = weakref.ref(moondream) if moondream is not None else lambda: None
+        # Rebinding the global is atomic; each request reads it once
+        moondream = model
+        del model
+        set_active_model(model_id, revision, load_seconds)
+        # Encodings belong to the previous model
+        image_store.drop_encodings()
+        reload_state.update(status="done", finished_at=time.time())
+        logger.info("model reload complete", extra={"fields": {"model_id": model_id, "revision": revision}})
+    except Exception as e:
+        reload_state.update(status="failed", error=str(e), finished_at=time.time())
+        logger.exception("model reload failed")
+        return
+    finally:
+        reload_lock.release()
+
+    wait_for_release(retired)
+
+
+def reload_target(model_id=None, revision=None):
+    """
+    Resolve a requested reload target, allowing only MODEL_ID (at
+    MODEL_REVISION or one of MODEL_RELOAD_REVISIONS) and the local
+    directories in MODEL_RELOAD_PATHS. Raises ValueError otherwise.
+    """
+    model_id = model_id or MODEL_ID
+    if model_id == MODEL_ID:
+        revision = revision or MODEL_REVISION
+        if revision != MODEL_REVISION and revision not in MODEL_RELOAD_REVISIONS:
+            raise ValueError(f"revision {revision!r} is not in MODEL_RELOAD_REVISIONS")
+        return model_id, revision
+    allowed = {os.path.realpath(path) for path in MODEL_RELOAD_PATHS}
+    if os.path.realpath(model_id) not in allowed:
+        raise ValueError(f"model_id {model_id!r} is not MODEL_ID or in MODEL_RELOAD_PATHS")
+    if revision:
+        raise ValueError("revision only applies to MODEL_ID")
+    if not os.path.isdir(model_id):
+        raise ValueError(f"model path {model_id!r} does not exist")
+    return model_id, None
+
+
+def start_model_reload(model_id, revision):
+    """Start a background reload; returns False if one is already running"""
+    if not reload_lock.acquire(blocking=False):
+        return False
+    reload_state.clear()
+    reload_state.update(status="loading", model_id=model_id, revision=revision, started_at=time.time())
+    threading.Thread(target=reload_model, args=(model_id, revision), name='model-reload', daemon=True).start()
+    return True
+
+
+def forward_reload_signal():
+    """Ask the inference owner to reload the configured model (client-mode SIGHUP)"""
+    try:
+        response = moondream.call({"op": "reload", "model_id": MODEL_ID, "revision": MODEL_REVISION},
+                                  time.time() + REQUEST_DEADLINE)
+        logger.info("reload forwarded to inference owner", extra={"fields": {
+            "started": response["started"],
+            "status": response["reload"].get("status"),
+        }})
+    except Exception as e:
+        logger.error("reload forward failed", extra={"fields": {"error": str(e)}})
+
+
+def handle_reload_signal(signum, frame):
+    """
+    SIGHUP: reload the configured model (e.g. after a local snapshot was updated).
+    A client-mode worker holds no model; it passes the reload on to the owner.
+    """
+    if INFERENCE_MODE == 'client':
+        threading.Thread(target=forward_reload_signal, daemon=True).start()
+        return
+    start_model_reload(MODEL_ID, MODEL_REVISION)
+
+
+if MODEL_RELOAD_ENABLED and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, handle_reload_signal)
+if MODEL_RELOAD_ENABLED and not ADMIN_API_KEY:
+    print("⚠ MODEL_RELOAD_ENABLED without ADMIN_API_KEY: /admin/reload is disabled, only SIGHUP reloads")
+
+
+@app.route('/admin/reload', methods=['POST'])
+@admin_key_required
+def admin_reload():
+    """
+    Load a new model revision or local path in the background and swap it in
+
+    Requires the X-Moondream-Admin-Auth header.
+
+    Expects JSON body (optional):
+    - model_id: MODEL_ID or a directory listed in MODEL_RELOAD_PATHS (default: MODEL_ID)
+    - revision: MODEL_REVISION or one of MODEL_RELOAD_REVISIONS (default: MODEL_REVISION)
+
+    Returns 202 immediately; poll GET /admin/reload or /health for progress.
+    """
+    if not MODEL_RELOAD_ENABLED:
+        return jsonify({"error": "Model reload is disabled (set MODEL_RELOAD_ENABLED=true)"}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        model_id, revision = reload_target(data.get('model_id'), data.get('revision'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if INFERENCE_MODE == 'client':
+        response = moondream.call({"op": "reload", "model_id": model_id, "revision": revision},
+                                  time.time() + REQUEST_DEADLINE)
+        return jsonify({"reload": response["reload"]}), 202 if response["started"] else 409
+    if not start_model_reload(model_id, revision):
+        return jsonify({"error": "A reload is already in progress", "reload": dict(reload_state)}), 409
+    return jsonify({"reload": dict(reload_state)}), 202
+
+
+@app.route('/admin/reload', methods=['GET'])
+@admin_key_required
+def admin_reload_status():
+    """Report the state of the last model reload"""
+    if not MODEL_RELOAD_ENABLED:
+        return jsonify({"error": "Model reload is disabled (set MODEL_RELOAD_ENABLED=true)"}), 404
+    if INFERENCE_MODE == 'client':
+        status = moondream.call({"op": "status"}, time.time() + REQUEST_DEADLINE)
+        active = {"model_id": status["model_id"], "revision": status["revision"],
+                  "loaded_at": status["model_loaded_at"], "load_seconds": status["model_load_seconds"]}
+        return jsonify({"active": active,
+                        "reload": {"status": status["reload_status"]}})
+    return jsonify({"active": dict(active_model), "reload": dict(reload_state)})
+
+
+# ============================================================
+# Asynchronous jobs
+# ============================================================
+
+# Set when a job is submitted so the worker does not wait for the next poll
+job_available = threading.Event()
+_job_worker_started = False
+
+
+def jobs_db():
+    """Open a connection to the job database, creating the schema if needed"""
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            callback_url TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    # Databases created before the attempt counter existed
+    columns = {column['name'] for column in conn.execute("PRAGMA table_info(jobs)")}
+    if 'attempts' not in columns:
+        try:
+            conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError as e:
+            # Another process migrated it first
+            if 'duplicate column' not in str(e):
+                raise
+    return conn
+
+
+def is_public_address(address):
+    """Whether an IP address is globally routable (IPv4-mapped IPv6 is judged as IPv4)"""
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_callback(callback_url):
+    """
+    Check a callback URL against JOB_CALLBACK_HOSTS (or, without it, against
+    non-public addresses) and return (parts, port, address) to deliver to.
+    Raises ValueError for URLs callbacks must not be sent to.
+    """
+    parts = urllib.parse.urlsplit(callback_url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    host = parts.hostname.lower()
+
+    if JOB_CALLBACK_HOSTS and host not in JOB_CALLBACK_HOSTS:
+        raise ValueError(f"callback_url host {host} is not in JOB_CALLBACK_HOSTS")
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)]
+    except socket.gaierror as e:
+        raise ValueError(f"callback_url host {host} cannot be resolved: {e}")
+    if not JOB_CALLBACK_HOSTS and not all(is_public_address(a) for a in addresses):
+        raise ValueError(f"callback_url host {host} resolves to a non-public address "
+                         "(list it in JOB_CALLBACK_HOSTS to allow it)")
+    # Connect to the address that was checked, not to a second lookup
+    return parts, port, addresses[0]
+
+
+class PinnedConnection(http.client.HTTPConnection):
+    """HTTP(S) connection to a host name at an address resolved in advance"""
+
+    def __init__(self, host, port, address, tls, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+        self.tls = tls
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        self.sock = sock
+
+
+def validate_job(data):
+    """
+    Validate a job submission and return (job_type, payload, callback_url).
+    The payload holds exactly what the worker needs to run the job.
+    """
+    job_type = data.get('type')
+    if job_type not in ('caption', 'query'):
+        raise ValueError("type must be 'caption' or 'query'")
+
+    image_url = data.get('image_url')
+    if not image_url:
+        raise ValueError("Missing image_url parameter")
+    if not image_url.startswith('data:image/'):
+        raise ValueError("Invalid image_url format. Expected data URL format: data:image/<type>;base64,<data>")
+
+    payload = {"image_url": image_url, "max_tokens": parse_max_tokens(data)}
+
+    if job_type == 'caption':
+        length = data.get('length', 'normal')
+        payload["length"] = length if length in ['short', 'normal', 'long'] else 'normal'
+    else:
+        question = data.get('question')
+        if not question:
+            raise ValueError("Missing question parameter")
+        payload["question"] = question
+
+    callback_url = data.get('callback_url')
+    if callback_url:
+        resolve_callback(callback_url)
+
+    return job_type, payload, callback_url
+
+
+def claim_job():
+    """
+    Atomically take the oldest queued job (or a running job whose lease expired).
+    Expired jobs that already used JOB_MAX_ATTEMPTS claims are failed on the way.
+    Returns (job row or None, ids of the jobs given up on).
+    """
+    now = time.time()
+    abandoned = []
+    conn = jobs_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        while True:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND started_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now - JOB_LEASE_SECONDS,)
+            ).fetchone()
+            if row is None or row['attempts'] < JOB_MAX_ATTEMPTS:
+                break
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (f"Job did not finish after {row['attempts']} attempts", now, row['id'])
+            )
+            abandoned.append(row['id'])
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, row['id'])
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+        conn.execute("COMMIT")
+        return row, abandoned
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def finish_job(job_id, status, result=None, error=None):
+    """Store the outcome of a job"""
+    conn = jobs_db()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+        )
+    finally:
+        conn.close()
+
+
+def purge_old_jobs():
+    """Delete finished jobs older than JOB_RETENTION_SECONDS"""
+    conn = jobs_db()
+    try:
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (time.time() - JOB_RETENTION_SECONDS,)
+        )
+    finally:
+        conn.close()
+
+
+def job_to_dict(row):
+    """Convert a job row to its API representation"""
+    job = {
+        "job_id": row['id'],
+        "type": row['type'],
+        "status": row['status'],
+        "created_at": row['created_at'],
+        "started_at": row['started_at'],
+        "finished_at": row['finished_at'],
+        "attempts": row['attempts'],
+    }
+    if row['result'] is not None:
+        job["result"] = json.loads(row['result'])
+    if row['error'] is not None:
+        job["error"] = row['error']
+    return job
+
+
+def run_job(job_type, payload, started_at):
+    """Run a job payload on the model and return its result dict"""
+    # The deadline runs from the claim, like the lease, so decoding and
+    # waiting for admission count against it
+    deadline = started_at + JOB_TIMEOUT
+    image = decode_base64_image(payload['image_url'])
+
+    if job_type == 'caption':
+        text, finish_reason = run_generation(
+            moondream.caption, "caption", payload['max_tokens'], deadline,
+            image=image, length=payload['length'],
+        )
+        return {"caption": text, "finish_reason": finish_reason}
+
+    text, finish_reason = run_generation(
+        moondream.query, "answer", payload['max_tokens'], deadline,
+        image=image, question=payload['question'],
+    )
+    return {"answer": text, "finish_reason": finish_reason}
+
+
+def send_callback(callback_url, job):
+    """
+    POST the finished job to its callback URL (best effort). The host is
+    checked again at delivery, and redirects are not followed.
+    """
+    try:
+        parts, port, address = resolve_callback(callback_url)
+        conn = PinnedConnection(parts.hostname, port, address, parts.scheme == 'https', CALLBACK_TIMEOUT)
+        try:
+            conn.request(
+                'POST',
+                urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')),
+                body=json.dumps(job).encode('utf-8'),
+                headers={'Content-Type': 'application/json'},
+            )
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 300:
+                raise RuntimeError(f"callback returned HTTP {resp.status}")
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.warning("job callback failed", extra={"request_id": job['job_id'], "fields": {
+            "callback_url": callback_url,
+            "error": str(e),
+        }})
+
+
+def notify_job(job_id):
+    """Send the finished job to its callback URL, if it has one"""
+    conn = jobs_db()
+    try:
+        finished = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if finished is None or not finished['callback_url']:
+        return
+    # Deliver off the worker thread so the GPU keeps getting work
+    threading.Thread(
+        target=send_callback,
+        args=(finished['callback_url'], job_to_dict(finished)),
+        daemon=True,
+    ).start()
+
+
+def job_worker():
+    """Background loop that feeds queued jobs to the GPU"""
+    last_purge = 0.0
+    while True:
+        try:
+            if time.time() - last_purge > 3600:
+                purge_old_jobs()
+                last_purge = time.time()
+
+            row, abandoned = claim_job()
+            for job_id in abandoned:
+                logger.warning("job abandoned", extra={"request_id": job_id, "fields": {
+                    "max_attempts": JOB_MAX_ATTEMPTS,
+                }})
+                notify_job(job_id)
+            if row is None:
+                job_available.wait(JOB_POLL_INTERVAL)
+                job_available.clear()
+                continue
+
+            try:
+                result = run_job(row['type'], json.loads(row['payload']), row['started_at'])
+                finish_job(row['id'], 'done', result=result)
+            except GenerationAborted as e:
+                finish_job(row['id'], 'failed', error=f"Generation aborted: {e.reason}")
+            except Exception as e:
+                finish_job(row['id'], 'failed', error=str(e))
+            notify_job(row['id'])
+        except Exception:
+            logger.exception("job worker error")
+            time.sleep(JOB_POLL_INTERVAL)
+
+
+def start_job_worker():
+    """Start the background job worker once per process"""
+    global _job_worker_started
+    if not JOBS_ENABLED or _job_worker_started:
+        return
+    os.makedirs(os.path.dirname(JOBS_DB_PATH) or '.', exist_ok=True)
+    jobs_db().close()
+    threading.Thread(target=job_worker, name='job-worker', daemon=True).start()
+    _job_worker_started = True
+    print(f"✓ Job worker started (queue: {JOBS_DB_PATH})")
+
+
+@app.route('/v1/jobs', methods=['POST'])
+@api_key_required
+def v1_create_job():
+    """
+    Submit an asynchronous caption/query job
+
+    Expects JSON body:
+    - type: "caption" or "query"
+    - image_url: base64 data URL
+    - length: caption length (caption jobs)
+    - question: question about the image (query jobs)
+    - max_tokens: maximum number of tokens to generate (optional)
+    - callback_url: URL that receives the finished job as a JSON POST (optional)
+
+    Returns 202 with the job id immediately.
+    """
+    if not JOBS_ENABLED:
+        return jsonify({"error": "Job API is disabled"}), 404
+    try:
+        with span('json_parse'):
+            data = request.get_json()
+        if not data:
+            return jsonify({"error": "Invalid JSON body"}), 400
+
+        job_type, payload, callback_url = validate_job(data)
+        job_id = f"job_{uuid.uuid4().hex}"
+        created_at = time.time()
+
+        conn = jobs_db()
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, type, payload, status, callback_url, created_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, job_type, json.dumps(payload), callback_url, created_at)
+            )
+        finally:
+            conn.close()
+        job_available.set()
+
+        return jsonify({"job_id": job_id, "status": "queued", "created_at": created_at}), 202
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+@api_key_required
+def v1_get_job(job_id):
+    """Poll the status and result of an asynchronous job"""
+    if not JOBS_ENABLED:
+        return jsonify({"error": "Job API is disabled"}), 404
+    conn = jobs_db()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_to_dict(row))
+
+
+# ============================================================
+# Inference owner process
+# ============================================================
+
+def send_message(conn, message):
+    """Send a length-prefixed JSON message"""
+    data = json.dumps(message).encode('utf-8')
+    conn.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv_exact(conn, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_message(conn):
+    """Receive a length-prefixed JSON message"""
+    (length,) = struct.unpack('!I', recv_exact(conn, 4))
+    return json.loads(recv_exact(conn, length))
+
+
+class RemoteModel:
+    """
+    Stand-in for the model in HTTP workers (INFERENCE_MODE=client).
+    Images travel to the inference-owner process through shared memory;
+    requests and results travel over a Unix socket, one connection per call.
+    Closing the connection cancels the generation in the owner.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    # Placeholders so run_generation can be handed moondream.caption/query;
+    # it dispatches them to generate() by name
+    def caption(self, *args, **kwargs):
+        raise RuntimeError("RemoteModel is only called through run_generation")
+
+    def query(self, *args, **kwargs):
+        raise RuntimeError("RemoteModel is only called through run_generation")
+
+    def call(self, message, deadline, cancelled=None):
+        """Send one message to the owner and wait for its reply"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.path)
+            send_message(conn, message)
+            while True:
+                readable, _, _ = select.select([conn], [], [], DISCONNECT_POLL_INTERVAL)
+                if readable:
+                    return recv_message(conn)
+                if cancelled is not None and cancelled():
+                    raise GenerationAborted("disconnect")
+                if time.time() >= deadline + INFERENCE_GRACE:
+                    raise GenerationAborted("deadline")
+
+    def generate(self, op, max_tokens, deadline, cancelled=None, image=None, **kwargs):
+        """Run a caption/query in the owner; returns (text, finish_reason)"""
+        message = {"op": op, "max_tokens": max_tokens, "deadline": deadline, **kwargs}
+        if isinstance(image, StoredImage):
+            response = self.call({**message, "image_id": image.image_id}, deadline, cancelled)
+        else:
+            with shared_image(image) as fields:
+                response = self.call({**message, **fields}, deadline, cancelled)
+        self._raise_for(response)
+        return response["text"], response["finish_reason"]
+
+    def store_image(self, image, encode, deadline, cancelled=None):
+        """Register an image in the owner's registry; returns (image_id, expires_at, encoded)"""
+        with shared_image(image) as fields:
+            response = self.call({"op": "put_image", "encode": encode, "deadline": deadline, **fields},
+                                 deadline, cancelled)
+        self._raise_for(response)
+        return response["image_id"], response["expires_at"], response["encoded"]
+
+    @staticmethod
+    def _raise_for(response):
+        if "aborted" in response:
+            raise GenerationAborted(response["aborted"])
+        if "not_found" in response:
+            raise ImageNotFound(response["not_found"])
+        if "error" in response:
+            raise RuntimeError(response["error"])
+
+
+@contextlib.contextmanager
+def shared_image(image):
+    """Copy an RGB image into a shared memory block for the owner; yields its message fields"""
+    data = image.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        del data
+        yield {"shm": shm.name, "size": list(image.size)}
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def attach_shared_image(name, size):
+    """Copy an RGB image out of a shared memory block created by a client"""
+    shm = shared_memory.SharedMemory(name=name)
+    # The client owns the block; keep our resource tracker from unlinking it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        view = shm.buf[:size[0] * size[1] * 3]
+        try:
+            return Image.frombytes('RGB', tuple(size), bytes(view))
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+def owner_generate(conn, message):
+    """Run a caption/query request received from a client"""
+    # The client closes its connection when its own client goes away
+    cancelled = lambda: client_disconnected(conn)
+    try:
+        if 'image_id' in message:
+            image = load_request_image({'image_id': message['image_id']})
+        else:
+            image = attach_shared_image(message['shm'], message['size'])
+        if message['op'] == 'caption':
+            text, finish_reason = run_generation(
+                moondream.caption, "caption", message['max_tokens'], message['deadline'],
+                cancelled=cancelled, image=image, length=message['length'],
+            )
+        else:
+            text, finish_reason = run_generation(
+                moondream.query, "answer", message['max_tokens'], message['deadline'],
+                cancelled=cancelled, image=image, question=message['question'],
+            )
+        return {"text": text, "finish_reason": finish_reason}
+    except GenerationAborted as e:
+        return {"aborted": e.reason}
+    except ImageNotFound as e:
+        return {"not_found": str(e)}
+
+
+def owner_put_image(conn, message):
+    """Register an image sent by a client in this process's registry"""
+    image = attach_shared_image(message['shm'], message['size'])
+    try:
+        image_id, expires_at, encoded = store_image(
+            image, message['encode'], message['deadline'], lambda: client_disconnected(conn))
+        return {"image_id": image_id, "expires_at": expires_at, "encoded": encoded}
+    except GenerationAborted as e:
+        return {"aborted": e.reason}
+
+
+def handle_owner_connection(conn):
+    """Serve one request from an HTTP worker"""
+    with conn:
+        try:
+            message = recv_message(conn)
+            op = message.get('op')
+            if op in ('caption', 'query'):
+                response = owner_generate(conn, message)
+            elif op == 'put_image':
+                response = owner_put_image(conn, message)
+            elif op == 'status':
+                response = inference_status()
+            elif op == 'reload':
+                model_id, revision = reload_target(message.get('model_id'), message.get('revision'))
+                started = MODEL_RELOAD_ENABLED and start_model_reload(model_id, revision)
+                response = {"started": bool(started), "reload": dict(reload_state)}
+            else:
+                response = {"error": f"Unknown op: {op}"}
+        except ConnectionError:
+            return
+        except Exception as e:
+            logger.exception("inference owner request failed")
+            response = {"error": str(e)}
+        try:
+            send_message(conn, response)
+        except OSError:
+            pass
+
+
+def serve_inference(path=INFERENCE_SOCKET):
+    """Accept requests from HTTP workers on a Unix socket (runs forever)"""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    print(f"✓ Inference owner listening on {path}")
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle_owner_connection, args=(conn,), daemon=True).start()
+
+
 def create_app():
     """
     Application factory for Gunicorn.
     Called when running with: gunicorn 'app:create_app()'
     """
     load_model()
+    start_job_worker()
     return app
 
 
@@ -768,12 +3354,19 @@ def ensure_model_loaded():
     global _model_loaded
     if not _model_loaded:
         load_model()
+        start_job_worker()
         _model_loaded = True
 
 
-if __name__ == '__main__':
+if __name__ == '__main__' and '--inference-owner' in sys.argv:
+    # Single process that owns the model: python app.py --inference-owner
+    INFERENCE_MODE = 'local'
+    load_model()
+    serve_inference()
+elif __name__ == '__main__':
     # Direct execution: python app.py
     load_model()
+    start_job_worker()
     print("\n" + "="*60)
     print("Moondream-2B HTTP Server Running!")
     print("Server: http://0.0.0.0:5000")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Continuous Batching Benchmark
+Replays mixed caption/query traffic against the CPU stub model, one request
+at a time and through the continuous batcher, and reports latency per kind,
+throughput, and whether every output matches the unbatched result
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+# Load app.py with the CPU stub model and without the job worker
+os.environ.setdefault('MODEL_BACKEND', 'stub')
+os.environ.setdefault('JOBS_ENABLED', 'false')
+os.environ.setdefault('STUB_TOKEN_DELAY', '0.005')
+# app.py sits next to scripts/ in the repo and in /app in the image (scripts
+# are copied to /scripts)
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), '/app']
+
+import app  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def make_requests(count, caption_share, seed):
+    """(kind, kwargs) pairs; captions are long, queries a few words"""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (640, 480))
+    requests = []
+    for i in range(count):
+        if rng.random() < caption_share:
+            requests.append(("caption", {"image": image, "length": "long"}))
+        else:
+            requests.append(("query", {"image": image, "question": f"what is in picture {i}"}))
+    return requests
+
+
+def expected_text(kind, kwargs, max_tokens):
+    """What the stub produces for a request when it runs alone"""
+    stub = app.StubMoondream(token_delay=0)
+    if kind == "caption":
+        return stub.caption(stream=False, settings={"max_tokens": max_tokens}, **kwargs)["caption"]
+    return stub.query(stream=False, settings={"max_tokens": max_tokens}, **kwargs)["answer"]
+
+
+def replay(requests, interval, max_tokens):
+    """Submit requests every interval seconds; returns [(kind, latency, text)]"""
+    model = app.moondream
+    results = [None] * len(requests)
+
+    def run(i, kind, kwargs):
+        func = model.caption if kind == "caption" else model.query
+        key = "caption" if kind == "caption" else "answer"
+        start = time.perf_counter()
+        text, _ = app.run_generation(func, key, max_tokens, time.time() + 300, **kwargs)
+        results[i] = (kind, time.perf_counter() - start, text)
+
+    threads = []
+    for i, (kind, kwargs) in enumerate(requests):
+        thread = threading.Thread(target=run, args=(i, kind, kwargs))
+        thread.start()
+        threads.append(thread)
+        time.sleep(interval)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(label, results, elapsed, requests, max_tokens):
+    print(f"{label}:")
+    for kind in ("query", "caption"):
+        latencies = [latency for k, latency, _ in results if k == kind]
+        if latencies:
+            print(f"  {kind:<8} n={len(latencies):<4} p50 {percentile(latencies, 0.5) * 1000:8.1f} ms"
+                  f"   p99 {percentile(latencies, 0.99) * 1000:8.1f} ms")
+    tokens = sum(len(text.split()) for _, _, text in results)
+    print(f"  throughput {tokens / elapsed:8.1f} tokens/s over {elapsed:.2f}s")
+    mismatches = sum(text != expected_text(kind, kwargs, max_tokens)
+                     for (kind, kwargs), (_, _, text) in zip(requests, results))
+    print(f"  outputs matching unbatched: {len(results) - mismatches}/{len(results)}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=60)
+    parser.add_argument('--caption-share', type=float, default=0.3)
+    parser.add_argument('--interval', type=float, default=0.01, help="seconds between arrivals")
+    parser.add_argument('--max-tokens', type=int, default=app.DEFAULT_MAX_TOKENS)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    requests = make_requests(args.requests, args.caption_share, args.seed)
+    print(f"{args.requests} requests, {args.caption_share:.0%} long captions, "
+          f"stub token delay {app.STUB_TOKEN_DELAY * 1000:.1f} ms")
+
+    # One request at a time: what the admission gate does without batching
+    app.batcher = None
+    start = time.perf_counter()
+    results = replay(requests, args.interval, args.max_tokens)
+    failures = report("serial", results, time.perf_counter() - start, requests, args.max_tokens)
+
+    app.batcher = app.ContinuousBatcher(app.KVBlockPool(app.kv_pool_blocks()), max_running=args.batch_size)
+    start = time.perf_counter()
+    results = replay(requests, args.interval, args.max_tokens)
+    failures += report(f"continuous (max {args.batch_size} running)", results,
+                       time.perf_counter() - start, requests, args.max_tokens)
+    snapshot = app.batcher.snapshot()
+    print(f"  peak running {snapshot['peak_running']}, decode steps {snapshot['steps']}, "
+          f"KV blocks peak {snapshot['kv_pool']['peak_in_use']}/{snapshot['kv_pool']['blocks']}, "
+          f"in use after {snapshot['kv_pool']['in_use']}")
+    return 1 if failures or snapshot['kv_pool']['in_use'] or snapshot['kv_pool']['reserved'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Logging Overhead Benchmark
+Measures the per-request cost of the structured logger on the request path,
+compared with the print() banners it replaced
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Load app.py with the CPU stub model and without the job worker
+os.environ.setdefault('MODEL_BACKEND', 'stub')
+os.environ.setdefault('JOBS_ENABLED', 'false')
+# app.py sits next to scripts/ in the repo and in /app in the image (scripts
+# are copied to /scripts)
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), '/app']
+
+import app  # noqa: E402
+
+
+def bench(label, fn, iterations):
+    """Time fn over iterations and print microseconds per call"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / iterations * 1e6:8.2f} µs/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    caption = "A black and white cat with green eyes rests on a wooden surface. " * 4
+    devnull = open(os.devnull, 'w')
+
+    def old_print(i):
+        # The banner v1_caption used to print per request
+        print(f"\n{'='*60}", file=devnull)
+        print(f"[v1 API] Inference Time: {0.123:.3f} seconds", file=devnull)
+        print("[v1 API] Caption Length: normal", file=devnull)
+        print(f"[v1 API] Caption: {caption}", file=devnull)
+        print(f"{'='*60}\n", file=devnull)
+
+    def structured(i):
+        request_id = app.new_request_id('caption')
+        app.logger.info("caption complete", extra={"request_id": request_id, "fields": {
+            "inference_time_ms": 123.0,
+            "length": "normal",
+            "finish_reason": "stop",
+            "output_chars": len(caption),
+        }})
+        app.logger.debug("caption text", extra={"request_id": request_id, "fields": {"caption": caption}})
+
+    # Send the structured logger's output to /dev/null as well
+    handler = app.logger.handlers[0]
+    handler.stream = devnull
+
+    print("=" * 60)
+    print(f"Logging overhead ({args.iterations} requests, output to /dev/null)")
+    print(f"LOG_LEVEL={app.LOG_LEVEL} LOG_SAMPLE_RATES={app.LOG_SAMPLE_RATES}")
+    print("=" * 60)
+    bench("print() banner (before)", old_print, args.iterations)
+    bench("structured logger, request path", structured, args.iterations)
+
+    start = time.perf_counter()
+    handler.drain()
+    drained = time.perf_counter() - start
+    print(f"{'background writer drain (off-path)':<40} {drained / args.iterations * 1e6:8.2f} µs/request")
+    print(f"Dropped records (queue full): {handler.dropped}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
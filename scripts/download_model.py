@@ -1,87 +1,365 @@
 #!/usr/bin/env python3
 """
 Model Download Script for Init Container
-Downloads the Moondream model with progress logging
+Provisions the Moondream model snapshot without loading weights:
+checks files against the snapshot manifest, downloads missing files in
+parallel with resume, and reports time and bytes per file.
+
+Sources:
+  hub                      Hugging Face Hub (default, honours HF_ENDPOINT)
+  /path/to/mirror          local mirror directory (optional manifest.json)
+  http://host:port/base    HTTP stand-in serving manifest.json and the files
 """
 
 import os
 import sys
+import json
 import time
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from huggingface_hub import snapshot_download
-import torch
+import hashlib
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-MODEL_ID = "moondream/moondream-2b-2025-04-14"
+MODEL_ID = os.environ.get('MODEL_ID', "moondream/moondream-2b-2025-04-14")
+MODEL_REVISION = os.environ.get('MODEL_REVISION') or None
 HF_TOKEN = os.environ.get('HF_TOKEN')
-CACHE_DIR = "/root/.cache/huggingface"
+HF_ENDPOINT = os.environ.get('HF_ENDPOINT', 'https://huggingface.co')
+CACHE_DIR = os.environ.get('HF_HUB_CACHE') or os.path.join(
+    os.environ.get('HF_HOME', os.path.expanduser('~/.cache/huggingface')), 'hub')
+
+MANIFEST_NAME = '.moondream-manifest.json'
+CHUNK_SIZE = 1024 * 1024
+HTTP_TIMEOUT = 60
+
+
+# ============================================================
+# Manifests
+# ============================================================
+
+def hub_manifest(revision):
+    """Fetch the file list, sizes and checksums of a Hub snapshot"""
+    from huggingface_hub import HfApi
+
+    info = HfApi(endpoint=HF_ENDPOINT).model_info(
+        MODEL_ID, revision=revision, files_metadata=True, token=HF_TOKEN)
+    files = []
+    for sibling in info.siblings:
+        entry = {"path": sibling.rfilename, "size": sibling.size}
+        if sibling.lfs is not None:
+            entry["sha256"] = sibling.lfs.sha256
+        elif sibling.blob_id:
+            entry["git_sha1"] = sibling.blob_id
+        files.append(entry)
+    return {"model_id": MODEL_ID, "revision": revision or "main", "commit": info.sha, "files": files}
+
+
+def mirror_manifest(mirror_dir, revision):
+    """Read manifest.json from a mirror directory, or build one by hashing its files"""
+    path = os.path.join(mirror_dir, 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    files = []
+    for root, _, names in os.walk(mirror_dir):
+        for name in sorted(names):
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, mirror_dir)
+            if rel.startswith('.'):
+                continue
+            files.append({"path": rel, "size": os.path.getsize(full), "sha256": file_sha256(full)})
+    return {"model_id": MODEL_ID, "revision": revision or "main", "commit": "mirror", "files": files}
+
+
+def http_manifest(base_url):
+    """Fetch manifest.json from an HTTP stand-in"""
+    with urllib.request.urlopen(f"{base_url.rstrip('/')}/manifest.json", timeout=HTTP_TIMEOUT) as resp:
+        return json.load(resp)
+
+
+def check_manifest(manifest, target):
+    """Refuse a manifest whose commit or file paths would write outside target"""
+    commit = manifest['commit']
+    if not commit or commit in ('.', '..') or '/' in commit or os.sep in commit:
+        raise ValueError(f"Manifest commit {commit!r} is not a plain directory name")
+    root = os.path.realpath(target)
+    for entry in manifest['files']:
+        path = entry['path']
+        if not path or os.path.isabs(path):
+            raise ValueError(f"Manifest path {path!r} must be relative")
+        if not os.path.realpath(os.path.join(root, path)).startswith(root + os.sep):
+            raise ValueError(f"Manifest path {path!r} escapes {target}")
+
+
+def fetch_manifest(source, revision):
+    if source == 'hub':
+        return hub_manifest(revision)
+    if source.startswith(('http://', 'https://')):
+        return http_manifest(source)
+    return mirror_manifest(source, revision)
+
+
+# ============================================================
+# Snapshot location
+# ============================================================
+
+def repo_cache_dir():
+    return os.path.join(CACHE_DIR, 'models--' + MODEL_ID.replace('/', '--'))
+
+
+def snapshot_dir(local_dir, commit):
+    """Directory the files of a snapshot go into"""
+    if local_dir:
+        return local_dir
+    return os.path.join(repo_cache_dir(), 'snapshots', commit)
+
+
+def cached_manifest(local_dir, revision):
+    """Return the manifest saved by a previous run, or None"""
+    if local_dir:
+        path = os.path.join(local_dir, MANIFEST_NAME)
+    else:
+        ref = os.path.join(repo_cache_dir(), 'refs', revision or 'main')
+        if not os.path.exists(ref):
+            return None
+        with open(ref) as f:
+            path = os.path.join(snapshot_dir(None, f.read().strip()), MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, local_dir, revision):
+    """Store the manifest with the snapshot and point the revision ref at it"""
+    target = snapshot_dir(local_dir, manifest['commit'])
+    with open(os.path.join(target, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    if not local_dir:
+        refs = os.path.join(repo_cache_dir(), 'refs')
+        os.makedirs(refs, exist_ok=True)
+        with open(os.path.join(refs, revision or 'main'), 'w') as f:
+            f.write(manifest['commit'])
+
+
+# ============================================================
+# Verification
+# ============================================================
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
-def download_model():
-    """Download Moondream model with progress"""
+def file_git_sha1(path, size):
+    """Git blob id, used by the Hub for files not stored in LFS"""
+    digest = hashlib.sha1(f"blob {size}\0".encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(target, entry, checksum=True):
+    """Return None if the file matches the manifest entry, otherwise the problem"""
+    path = os.path.join(target, entry['path'])
+    if not os.path.exists(path):
+        return "missing"
+    size = os.path.getsize(path)
+    if entry.get('size') is not None and size != entry['size']:
+        return f"size {size} != {entry['size']}"
+    if checksum:
+        if entry.get('sha256') and file_sha256(path) != entry['sha256']:
+            return "sha256 mismatch"
+        if not entry.get('sha256') and entry.get('git_sha1') and file_git_sha1(path, size) != entry['git_sha1']:
+            return "git sha1 mismatch"
+    return None
+
+
+def verify_snapshot(manifest, local_dir, workers, checksum=True):
+    """Check every file of the manifest in parallel; returns {path: problem} for bad files"""
+    target = snapshot_dir(local_dir, manifest['commit'])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda entry: (entry['path'], verify_file(target, entry, checksum)), manifest['files'])
+        return {path: problem for path, problem in results if problem}
+
+
+# ============================================================
+# Transfer
+# ============================================================
+
+def open_source(source, manifest, entry, offset):
+    """
+    Open a file from the source starting at offset.
+    Returns (stream, resumed) where resumed tells whether the source honoured the offset.
+    """
+    if source == 'hub' or source.startswith(('http://', 'https://')):
+        if source == 'hub':
+            from huggingface_hub import hf_hub_url
+            url = hf_hub_url(MODEL_ID, entry['path'], revision=manifest['commit'], endpoint=HF_ENDPOINT)
+        else:
+            url = f"{source.rstrip('/')}/{entry['path']}"
+        req = urllib.request.Request(url)
+        if source == 'hub' and HF_TOKEN:
+            req.add_header('Authorization', f"Bearer {HF_TOKEN}")
+        if offset:
+            req.add_header('Range', f"bytes={offset}-")
+        try:
+            resp = urllib.request.urlopen(req, timeout=HTTP_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            # 416: nothing left after offset (or the file shrank); start over
+            if e.code == 416 and offset:
+                e.close()
+                return open_source(source, manifest, entry, 0)
+            raise
+        return resp, offset > 0 and resp.status == 206
+
+    f = open(os.path.join(source, entry['path']), 'rb')
+    f.seek(offset)
+    return f, offset > 0
+
+
+def transfer_file(source, manifest, entry, target, checksum=True):
+    """
+    Fetch one file into target, resuming a partial .incomplete file if present.
+    Returns a report dict with bytes transferred and elapsed time.
+    """
+    start = time.time()
+    path = os.path.join(target, entry['path'])
+    partial = path + '.incomplete'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if entry.get('size') is not None and offset >= entry['size']:
+        # A full-size partial means the previous run stopped before the
+        # rename; asking for bytes past the end would get HTTP 416
+        if offset == entry['size']:
+            os.replace(partial, path)
+            if verify_file(target, entry, checksum) is None:
+                return {"path": entry['path'], "bytes": 0, "resumed_from": offset,
+                        "elapsed": time.time() - start}
+            os.remove(path)
+        offset = 0
+
+    stream, resumed = open_source(source, manifest, entry, offset)
+    transferred = 0
+    with stream, open(partial, 'ab' if resumed else 'wb') as out:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            out.write(chunk)
+            transferred += len(chunk)
+    os.replace(partial, path)
+
+    return {
+        "path": entry['path'],
+        "bytes": transferred,
+        "resumed_from": offset if resumed else 0,
+        "elapsed": time.time() - start,
+    }
+
+
+def print_report(reports):
+    print(f"{'File':<44} {'Bytes':>14} {'Time':>8} {'MB/s':>8}")
+    for report in sorted(reports, key=lambda r: -r['bytes']):
+        rate = report['bytes'] / report['elapsed'] / 1e6 if report['elapsed'] > 0 else 0.0
+        note = f" (resumed at {report['resumed_from']})" if report['resumed_from'] else ""
+        print(f"{report['path'][:44]:<44} {report['bytes']:>14,} {report['elapsed']:>7.1f}s {rate:>8.1f}{note}")
+
+
+# ============================================================
+# Main
+# ============================================================
+
+def download_model(args):
+    """Verify the snapshot and download whatever is missing or corrupt"""
     print("=" * 60)
-    print("🔥 Starting Moondream Model Download")
+    print("🔥 Starting Moondream Model Provisioning")
     print("=" * 60)
     print(f"Model ID: {MODEL_ID}")
-    print(f"Cache directory: {CACHE_DIR}")
+    print(f"Revision: {args.revision or 'default'}")
+    print(f"Source: {args.source}")
+    print(f"Target: {args.local_dir or CACHE_DIR}")
     print(f"HuggingFace Token: {'✓ Set' if HF_TOKEN else '✗ Not set (will use public access)'}")
     print()
 
     start_time = time.time()
+    checksum = not args.no_checksum
 
     try:
         print("📥 Checking for existing model files...")
-        # Check if the model is already downloaded
-        try:
-            AutoModelForCausalLM.from_pretrained(
-                MODEL_ID,
-                trust_remote_code=True,
-                local_files_only=True,
-                token=HF_TOKEN,
-            )
-            print("✅ Model already exists in cache. No download needed.")
+        manifest = cached_manifest(args.local_dir, args.revision)
+        if manifest is not None:
+            check_manifest(manifest, snapshot_dir(args.local_dir, manifest['commit']))
+            problems = verify_snapshot(manifest, args.local_dir, args.workers, checksum)
+            if not problems:
+                print(f"✅ Model already provisioned ({len(manifest['files'])} files verified "
+                      f"in {time.time() - start_time:.1f}s). No download needed.")
+                print("=" * 60)
+                return 0
+            print(f"   {len(problems)} file(s) need attention")
+
+        if manifest is None or args.refresh_manifest:
+            manifest = fetch_manifest(args.source, args.revision)
+        target = snapshot_dir(args.local_dir, manifest['commit'])
+        check_manifest(manifest, target)
+        os.makedirs(target, exist_ok=True)
+
+        problems = verify_snapshot(manifest, args.local_dir, args.workers, checksum)
+        if args.verify:
+            for path, problem in sorted(problems.items()):
+                print(f"   ✗ {path}: {problem}")
+            status = "✅ Snapshot verified" if not problems else f"❌ {len(problems)} file(s) failed verification"
+            print(status)
             print("=" * 60)
-            return 0
-        except EnvironmentError:
-            print("   Model not found in cache. Starting download...")
+            return 0 if not problems else 1
 
-        print("   This may take 5-15 minutes depending on network speed")
-        print("   Model size: ~4GB compressed, ~9GB uncompressed")
+        pending = [entry for entry in manifest['files'] if entry['path'] in problems]
+        total = sum(entry.get('size') or 0 for entry in pending)
+        print(f"   Downloading {len(pending)} file(s), {total / 1e9:.2f} GB with {args.workers} workers")
         print()
 
-        # Download model using snapshot_download for better progress
-        snapshot_download(
-            repo_id=MODEL_ID,
-            cache_dir=CACHE_DIR,
-            token=HF_TOKEN,
-            resume_download=True,
-        )
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            reports = list(pool.map(lambda entry: transfer_file(args.source, manifest, entry, target, checksum), pending))
+        print_report(reports)
 
-        # Verify download by loading the model
         print("\n🔍 Verifying model files...")
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
-            trust_remote_code=True,
-            token=HF_TOKEN,
-            torch_dtype=torch.bfloat16,
-            attn_implementation="eager",
-            low_cpu_mem_usage=True,
-        ).cuda()
+        problems = verify_snapshot(manifest, args.local_dir, args.workers, checksum)
+        if problems:
+            # A resumed partial file may have been corrupt; fetch those again from scratch
+            print(f"   Retrying {len(problems)} file(s) from scratch")
+            retry = [entry for entry in manifest['files'] if entry['path'] in problems]
+            for entry in retry:
+                for suffix in ('', '.incomplete'):
+                    path = os.path.join(target, entry['path'] + suffix)
+                    if os.path.exists(path):
+                        os.remove(path)
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                retried = list(pool.map(lambda entry: transfer_file(args.source, manifest, entry, target, checksum), retry))
+            print_report(retried)
+            reports += retried
+            problems = verify_snapshot(manifest, args.local_dir, args.workers, checksum)
+        if problems:
+            for path, problem in sorted(problems.items()):
+                print(f"   ✗ {path}: {problem}")
+            raise RuntimeError(f"{len(problems)} file(s) failed verification")
+        save_manifest(manifest, args.local_dir, args.revision)
 
         elapsed = time.time() - start_time
+        transferred = sum(report['bytes'] for report in reports)
 
         print()
         print("=" * 60)
         print("✅ Model Download Complete and Verified!")
         print("=" * 60)
         print(f"⏱️  Time taken: {elapsed:.1f} seconds ({elapsed/60:.1f} minutes)")
-        print(f"💾 Cache location: {CACHE_DIR}")
+        print(f"📦 Transferred: {transferred / 1e9:.2f} GB ({transferred / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+        print(f"💾 Snapshot location: {target}")
         print()
         print("🚀 Model ready for inference!")
         print("=" * 60)
-
-        # Cleanup to free memory
-        del model
-        torch.cuda.empty_cache()
-
         return 0
 
     except Exception as e:
@@ -92,12 +370,28 @@ def download_model():
         print(f"Error: {e}")
         print()
         print("Possible issues:")
-        print("  • Network connectivity to huggingface.co")
+        print("  • Network connectivity to huggingface.co (or the configured source)")
         print("  • Invalid HuggingFace token")
         print("  • Insufficient disk space")
-        print("  • CUDA/GPU not available")
+        print("  • Mirror missing files listed in its manifest")
         print("=" * 60)
         return 1
 
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Provision the Moondream model snapshot")
+    parser.add_argument('--source', default=os.environ.get('MODEL_SOURCE', 'hub'),
+                        help="hub, a local mirror directory, or an http(s) base URL")
+    parser.add_argument('--revision', default=MODEL_REVISION)
+    parser.add_argument('--local-dir', default=os.environ.get('MODEL_LOCAL_DIR') or None,
+                        help="write a flat snapshot here instead of the Hugging Face cache")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('DOWNLOAD_WORKERS', '8')))
+    parser.add_argument('--verify', action='store_true', help="only check files, do not download")
+    parser.add_argument('--no-checksum', action='store_true', help="check file sizes only")
+    parser.add_argument('--refresh-manifest', action='store_true',
+                        help="fetch the manifest from the source even if one is cached")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    sys.exit(download_model())
+    sys.exit(download_model(parse_args()))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Weight Snapshot Export
+Converts the Moondream weights once into a local snapshot the server can
+memory-map: tensors are stored already in the serving dtype and layout, next
+to the config and remote code, so a cold start skips conversion and copying.
+
+Usage:
+  python scripts/export_snapshot.py --output /models/moondream-snapshot
+  MODEL_ID=/models/moondream-snapshot gunicorn ...
+
+  # Compare cold start (time, peak RSS) of from_pretrained and the snapshot
+  python scripts/export_snapshot.py --compare /models/moondream-snapshot
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# snapshot.py sits next to scripts/ in the repo and in /app in the image
+# (scripts are copied to /scripts)
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), '/app']
+
+from snapshot import SNAPSHOT_WEIGHTS, load_weights, peak_rss_mb, save_snapshot  # noqa: E402
+
+MODEL_ID = os.environ.get('MODEL_ID', "moondream/moondream-2b-2025-04-14")
+MODEL_REVISION = os.environ.get('MODEL_REVISION') or None
+HF_TOKEN = os.environ.get('HF_TOKEN')
+# Cold-start comparisons load onto this device (cpu needs no GPU)
+MODEL_DEVICE = os.environ.get('MODEL_DEVICE', 'cpu')
+
+
+def export_snapshot(args):
+    """Load the model once and write config, remote code and weights to args.output"""
+    print("=" * 60)
+    print("📦 Moondream Snapshot Export")
+    print("=" * 60)
+    print(f"Model: {args.model_id}" + (f" @ {args.revision}" if args.revision else ""))
+    print(f"Output: {args.output}")
+    print(f"Dtype: {args.dtype}")
+    print()
+
+    try:
+        import torch
+        from transformers import AutoModelForCausalLM
+        from transformers.dynamic_module_utils import custom_object_save
+
+        start_time = time.time()
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_id,
+            revision=args.revision,
+            trust_remote_code=True,
+            token=HF_TOKEN,
+            torch_dtype=getattr(torch, args.dtype),
+            attn_implementation="eager",
+            low_cpu_mem_usage=True,
+        ).eval()
+        print(f"✓ Loaded in {time.time() - start_time:.1f}s")
+
+        os.makedirs(args.output, exist_ok=True)
+        # Copies the remote code and points auto_map at it, so the snapshot
+        # loads without the Hub
+        if model._auto_class is not None:
+            custom_object_save(model, args.output, config=model.config)
+        model.config.save_pretrained(args.output)
+
+        manifest = save_snapshot(model, args.output, args.dtype,
+                                 model_id=args.model_id, revision=args.revision)
+        parameters, buffers = manifest["parameters"], manifest["buffers"]
+        size = os.path.getsize(os.path.join(args.output, SNAPSHOT_WEIGHTS))
+        print()
+        print("=" * 60)
+        print("✅ Snapshot Export Complete!")
+        print("=" * 60)
+        print(f"⏱️  Time taken: {time.time() - start_time:.1f} seconds")
+        print(f"📦 Weights: {size / 1e9:.2f} GB, {len(parameters)} parameters, {len(buffers)} buffers")
+        print(f"💾 Snapshot location: {args.output}")
+        print()
+        print(f"🚀 Serve it with MODEL_ID={args.output}")
+        print("=" * 60)
+        return 0
+
+    except Exception as e:
+        print()
+        print("=" * 60)
+        print("❌ Snapshot Export Failed!")
+        print("=" * 60)
+        print(f"Error: {e}")
+        print("=" * 60)
+        return 1
+
+
+def measure_load(model_id, revision):
+    """Load once in this process and print load time and peak RSS as JSON"""
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    model = load_weights(model_id, revision, HF_TOKEN).to(MODEL_DEVICE)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "seconds": round(elapsed, 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "baseline_rss_mb": baseline,
+        "device": str(next(model.parameters()).device),
+    }))
+    return 0
+
+
+def compare(args):
+    """Cold-start each loader in a fresh process and print a comparison"""
+    print("=" * 60)
+    print("⏱️  Cold Start Comparison")
+    print("=" * 60)
+    results = {}
+    for label, model_id, revision in (("from_pretrained", args.model_id, args.revision),
+                                      ("snapshot", args.compare, None)):
+        command = [sys.executable, os.path.abspath(__file__), '--measure-load', model_id]
+        if revision:
+            command += ['--revision', revision]
+        proc = subprocess.run(command, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ {label} failed:\n{proc.stderr.strip()}")
+            return 1
+        results[label] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    print(f"{'loader':<18} {'seconds':>10} {'peak RSS MB':>12} {'baseline MB':>12}")
+    for label, result in results.items():
+        print(f"{label:<18} {result['seconds']:>10} {result['peak_rss_mb']:>12} {result['baseline_rss_mb']:>12}")
+    print(f"(device: {MODEL_DEVICE}; peak RSS counts resident mmap pages)")
+    print("=" * 60)
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export a memory-mappable Moondream weight snapshot")
+    parser.add_argument('--model-id', default=MODEL_ID, help="Hugging Face model id or local path")
+    parser.add_argument('--revision', default=MODEL_REVISION)
+    parser.add_argument('--output', help="snapshot directory to write")
+    parser.add_argument('--dtype', default='bfloat16', choices=['bfloat16', 'float16', 'float32'])
+    parser.add_argument('--compare', metavar='SNAPSHOT',
+                        help="compare cold start of --model-id and this snapshot")
+    parser.add_argument('--measure-load', metavar='MODEL', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if not (args.output or args.compare or args.measure_load):
+        parser.error("one of --output or --compare is required")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.measure_load:
+        sys.exit(measure_load(args.measure_load, args.revision))
+    if args.compare:
+        sys.exit(compare(args))
+    sys.exit(export_snapshot(args))
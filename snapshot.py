@@ -0,0 +1,123 @@
+"""
+Memory-mappable weight snapshots
+Written once by scripts/export_snapshot.py and loaded by app.py: tensors are
+stored in the serving dtype next to the config and remote code, and loading
+builds the model on the meta device and attaches the mmap'ed tensors.
+Kept out of app.py so the export tool does not have to import the server.
+"""
+
+import os
+import json
+import resource
+from datetime import datetime
+
+import torch
+
+# The manifest is written last: its presence marks a complete snapshot
+SNAPSHOT_MANIFEST = 'moondream-snapshot.json'
+SNAPSHOT_WEIGHTS = 'weights.pt'
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_MANIFEST))
+
+
+def attach_tensor(model, name, tensor, parameter):
+    """Replace a meta tensor on the model with a loaded one, without copying"""
+    module_name, _, attr = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if parameter:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attr] = tensor
+
+
+def save_snapshot(model, path, dtype, **metadata):
+    """
+    Write the parameters (cast to dtype, a torch dtype name) and buffers of
+    model to path, then the manifest. Extra metadata goes into the manifest.
+    Returns the manifest.
+    """
+    os.makedirs(path, exist_ok=True)
+    torch_dtype = getattr(torch, dtype)
+
+    # Tied weights are listed under every name; torch.save keeps them as one storage
+    tensors = {}
+    parameters = []
+    for name, param in model.named_parameters(remove_duplicate=False):
+        tensor = param.detach()
+        tensors[name] = (tensor.to(torch_dtype) if tensor.is_floating_point() else tensor).contiguous()
+        parameters.append(name)
+    # Non-persistent buffers too: the model is rebuilt on the meta device,
+    # so nothing computed in __init__ survives
+    buffers = []
+    for name, buffer in model.named_buffers(remove_duplicate=False):
+        tensors[name] = buffer.contiguous()
+        buffers.append(name)
+
+    weights_path = os.path.join(path, SNAPSHOT_WEIGHTS)
+    torch.save(tensors, weights_path + '.incomplete')
+    os.replace(weights_path + '.incomplete', weights_path)
+
+    manifest = dict(metadata, format=1, dtype=dtype, parameters=parameters, buffers=buffers,
+                    created_at=datetime.now().isoformat())
+    with open(os.path.join(path, SNAPSHOT_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def build_from_config(path, dtype):
+    """Build the (remote code) model described by the config saved in path"""
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    return AutoModelForCausalLM.from_config(
+        config,
+        trust_remote_code=True,
+        torch_dtype=dtype,
+        attn_implementation="eager",
+    )
+
+
+def load_snapshot(path, build=build_from_config):
+    """
+    Load a snapshot written by save_snapshot.
+    build(path, dtype) constructs the model; it runs on the meta device and
+    the weights, already in their serving dtype, are attached as
+    memory-mapped tensors: nothing is initialised, converted or copied, and
+    pages are read on first touch.
+    """
+    with open(os.path.join(path, SNAPSHOT_MANIFEST)) as f:
+        manifest = json.load(f)
+    with torch.device('meta'):
+        model = build(path, getattr(torch, manifest["dtype"]))
+
+    tensors = torch.load(os.path.join(path, SNAPSHOT_WEIGHTS), map_location='cpu', mmap=True, weights_only=True)
+    for name in manifest["parameters"]:
+        attach_tensor(model, name, tensors[name], parameter=True)
+    for name in manifest["buffers"]:
+        attach_tensor(model, name, tensors[name], parameter=False)
+    return model.eval()
+
+
+def load_weights(model_id, revision=None, token=None):
+    """Load a model on the CPU from a snapshot, a Hugging Face id or a local path"""
+    if is_snapshot(model_id):
+        return load_snapshot(model_id)
+    from transformers import AutoModelForCausalLM
+
+    # Load model with specific config to avoid transformers compatibility issues
+    return AutoModelForCausalLM.from_pretrained(
+        model_id,
+        revision=revision,
+        trust_remote_code=True,
+        token=token,
+        torch_dtype=torch.bfloat16,
+        attn_implementation="eager",
+        low_cpu_mem_usage=True,
+    )
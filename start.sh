@@ -22,8 +22,30 @@ echo "  Preprocess Workers: ${PREPROCESS_WORKERS:-4}"
 echo "  Batch Enabled: ${BATCH_ENABLED:-false}"
 echo "  Gunicorn Workers: ${GUNICORN_WORKERS:-1}"
 echo "  Gunicorn Threads: ${GUNICORN_THREADS:-4}"
+echo "  Inference Mode: ${INFERENCE_MODE:-local}"
 echo ""
 
+# client 模式: 单独的推理进程持有模型，Gunicorn worker 只做解析和预处理
+if [ "${INFERENCE_MODE:-local}" = "client" ]; then
+    export INFERENCE_SOCKET=${INFERENCE_SOCKET:-/tmp/moondream-inference.sock}
+    rm -f "$INFERENCE_SOCKET"
+    echo "🧠 启动推理进程 (socket: $INFERENCE_SOCKET)..."
+    python3 app.py --inference-owner &
+    OWNER_PID=$!
+    # 等待模型加载完成、socket 就绪
+    while [ ! -S "$INFERENCE_SOCKET" ]; do
+        if ! kill -0 $OWNER_PID 2>/dev/null; then
+            echo "❌ 推理进程启动失败"
+            exit 1
+        fi
+        sleep 1
+    done
+    echo "✓ 推理进程已就绪"
+elif [ "${GUNICORN_WORKERS:-1}" -gt 1 ]; then
+    # local 模式下每个 worker 各自加载模型并持有自己的图片注册表
+    echo "⚠ INFERENCE_MODE=local 且 GUNICORN_WORKERS>1: 每个 worker 加载一份模型，image_id 只在上传它的 worker 有效"
+fi
+
 # 启动服务
 echo "🚀 启动服务 (Gunicorn + Gevent)..."
 
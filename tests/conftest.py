@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time: run it on the CPU stub model,
+# with a budget large enough for a few concurrent stub requests
+os.environ.update(
+    MODEL_BACKEND='stub',
+    STUB_TOKEN_DELAY='0.01',
+    GPU_MEMORY_BUDGET_MB='4096',
+    JOBS_ENABLED='false',
+    MODEL_RELOAD_ENABLED='true',
+    ADMIN_API_KEY='test-admin-key',
+    VLM_API_KEY='',
+    IMAGE_STORE_DIR=tempfile.mkdtemp(prefix='moondream-test-images-'),
+)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def client():
+    import app
+    return app.app.test_client()
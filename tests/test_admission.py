@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def acquire_in_thread(admission, name, cost, order, **kwargs):
+    """Acquire cost in a thread, appending name to order once admitted"""
+    result = {}
+
+    def run():
+        result['admitted'] = admission.acquire(cost, **kwargs)
+        if result['admitted']:
+            order.append(name)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def test_admits_in_arrival_order_across_polls():
+    # A small request that would fit must not overtake a large one queued
+    # before it, even after several cancellation polls
+    admission = app.MemoryAdmission(100)
+    assert admission.acquire(60)
+    order = []
+    never = lambda: False
+    large, _ = acquire_in_thread(admission, 'large', 80, order, timeout=10, cancelled=never)
+    time.sleep(0.1)
+    small, _ = acquire_in_thread(admission, 'small', 30, order, timeout=10, cancelled=never)
+    time.sleep(app.DISCONNECT_POLL_INTERVAL * 2.5)
+    assert order == []
+    assert admission.snapshot()['waiting'] == 2
+
+    admission.release(60)
+    large.join(timeout=5)
+    assert order == ['large']
+    # 80 + 30 exceeds the budget, so the small request still waits
+    time.sleep(0.1)
+    assert order == ['large']
+
+    admission.release(80)
+    small.join(timeout=5)
+    assert order == ['large', 'small']
+    assert admission.snapshot()['in_use_mb'] == 30
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    admission = app.MemoryAdmission(100)
+    assert admission.acquire(100)
+    gone = threading.Event()
+    order = []
+    waiter, result = acquire_in_thread(admission, 'waiter', 10, order, timeout=10, cancelled=gone.is_set)
+    time.sleep(0.1)
+    gone.set()
+    waiter.join(timeout=app.DISCONNECT_POLL_INTERVAL * 3)
+    assert result['admitted'] is False
+    assert admission.snapshot()['waiting'] == 0
+    admission.release(100)
+    assert admission.acquire(10, timeout=0)
+
+
+def test_timeout_gives_up_without_reserving():
+    admission = app.MemoryAdmission(100)
+    assert admission.acquire(90)
+    start = time.monotonic()
+    assert admission.acquire(20, timeout=0.2) is False
+    assert time.monotonic() - start < 1.0
+    assert admission.snapshot()['in_use_mb'] == 90
+    assert admission.snapshot()['waiting'] == 0
+
+
+def test_oversized_request_is_admitted_alone():
+    admission = app.MemoryAdmission(100)
+    assert admission.acquire(500, timeout=0)
+    assert admission.acquire(1, timeout=0) is False
+    admission.release(500)
+    assert admission.snapshot()['in_use_mb'] == 0
+
+
+def test_concurrent_reservations_never_exceed_budget():
+    admission = app.MemoryAdmission(100)
+    lock = threading.Lock()
+    in_flight = {'mb': 0, 'peak': 0}
+
+    def request(cost):
+        assert admission.acquire(cost, timeout=10)
+        with lock:
+            in_flight['mb'] += cost
+            in_flight['peak'] = max(in_flight['peak'], in_flight['mb'])
+        time.sleep(0.02)
+        with lock:
+            in_flight['mb'] -= cost
+        admission.release(cost)
+
+    threads = [threading.Thread(target=request, args=(cost,)) for cost in [30, 45, 20, 60, 10, 35] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight['peak'] <= 100
+    assert admission.snapshot()['peak_mb'] <= 100
+    assert admission.snapshot()['active'] == 0
+
+
+def test_admitted_raises_deadline_while_queued(monkeypatch):
+    monkeypatch.setattr(app, 'admission', app.MemoryAdmission(100))
+    assert app.admission.acquire(100)
+    with pytest.raises(app.GenerationAborted) as e:
+        with app.admitted(50, time.time() + 0.2, exclusive=False):
+            pass
+    assert e.value.reason == 'deadline'
+    assert app.admission.snapshot()['waiting'] == 0
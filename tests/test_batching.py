@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+IMAGE = Image.new('RGB', (64, 64))
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    batcher = app.ContinuousBatcher(app.KVBlockPool(app.kv_pool_blocks()), max_running=4)
+    monkeypatch.setattr(app, 'batcher', batcher)
+    return batcher
+
+
+def generate(model, kind, max_tokens, results, name, deadline=30.0):
+    func = model.caption if kind == 'caption' else model.query
+    key = 'caption' if kind == 'caption' else 'answer'
+    kwargs = {'length': 'long'} if kind == 'caption' else {'question': f'what is in {name}'}
+    text, finish_reason = app.run_generation(func, key, max_tokens, time.time() + deadline, image=IMAGE, **kwargs)
+    results[name] = (time.monotonic(), text, finish_reason)
+
+
+def test_batched_outputs_match_unbatched(batcher):
+    model = app.StubMoondream(token_delay=0.005)
+    results = {}
+    threads = [threading.Thread(target=generate, args=(model, kind, 20, results, f'{kind}{i}'))
+               for i, kind in enumerate(['caption', 'query'] * 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reference = app.StubMoondream(token_delay=0)
+    for name, (_, text, finish_reason) in results.items():
+        if name.startswith('caption'):
+            expected = reference.caption(IMAGE, length='long', settings={"max_tokens": 20})['caption']
+            assert finish_reason == 'length'
+        else:
+            expected = reference.query(IMAGE, f'what is in {name}', settings={"max_tokens": 20})['answer']
+            assert finish_reason == 'stop'
+        assert text == expected
+    snapshot = batcher.snapshot()
+    assert snapshot['peak_running'] > 1
+    assert snapshot['kv_pool']['in_use'] == 0
+    assert snapshot['kv_pool']['reserved'] == 0
+
+
+def test_short_query_leaves_before_long_caption(batcher):
+    model = app.StubMoondream(token_delay=0.005)
+    results = {}
+    caption = threading.Thread(target=generate, args=(model, 'caption', 100, results, 'caption'))
+    caption.start()
+    time.sleep(0.05)
+    query = threading.Thread(target=generate, args=(model, 'query', 100, results, 'query'))
+    query.start()
+    query.join()
+    assert 'caption' not in results
+    caption.join()
+    assert results['query'][0] < results['caption'][0]
+
+
+def test_sequence_past_deadline_while_queued_is_aborted(batcher):
+    batcher.max_running = 1
+    model = app.StubMoondream(token_delay=0.01)
+    results = {}
+    caption = threading.Thread(target=generate, args=(model, 'caption', 100, results, 'caption', 0.5))
+    caption.start()
+    time.sleep(0.05)
+    with pytest.raises(app.GenerationAborted) as e:
+        generate(model, 'query', 10, results, 'query', deadline=0.2)
+    assert e.value.reason == 'deadline'
+    caption.join()
+    assert results['caption'][2] == 'timeout'
+
+
+def test_wait_gives_up_when_the_batcher_is_stuck(monkeypatch):
+    monkeypatch.setattr(app, 'INFERENCE_GRACE', 0.1)
+    # Never submitted: stands in for a sequence whose batcher loop has died
+    sequence = app.Sequence(app.StubMoondream(), 'query', 10, time.time() + 0.1, {})
+    start = time.monotonic()
+    with pytest.raises(app.GenerationAborted) as e:
+        app.wait_for_sequence(sequence)
+    assert e.value.reason == 'deadline'
+    assert sequence.cancelled
+    assert time.monotonic() - start < 2.0
+
+
+class PlainModel:
+    """A streaming model without prefill/decode_step, like moondream"""
+    reentrant = True
+
+    def query(self, image, question, stream, settings):
+        return {"answer": iter(["plain ", "answer"])}
+
+
+def test_models_without_step_interface_fall_back(batcher):
+    assert app.supports_batching(app.StubMoondream())
+    model = PlainModel()
+    assert not app.supports_batching(model)
+    text, finish_reason = app.run_generation(model.query, 'answer', 10, time.time() + 5,
+                                             image=Image.new('RGB', (64, 64)), question='what?')
+    assert (text, finish_reason) == ("plain answer", "stop")
+    assert batcher.snapshot()['steps'] == 0
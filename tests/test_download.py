@@ -0,0 +1,97 @@
+import hashlib
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import download_model  # noqa: E402
+
+CONTENT = bytes(range(256)) * 64
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves CONTENT at any path; a Range past the end gets 416 like the Hub"""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def source():
+    RangeHandler.requests = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def entry(size=len(CONTENT), sha256=hashlib.sha256(CONTENT).hexdigest()):
+    return {"path": "model.safetensors", "size": size, "sha256": sha256}
+
+
+def test_full_size_partial_is_renamed_without_a_request(source, tmp_path):
+    (tmp_path / 'model.safetensors.incomplete').write_bytes(CONTENT)
+    report = download_model.transfer_file(source, {"commit": "c"}, entry(), str(tmp_path))
+    assert RangeHandler.requests == []
+    assert report['bytes'] == 0
+    assert (tmp_path / 'model.safetensors').read_bytes() == CONTENT
+    assert not (tmp_path / 'model.safetensors.incomplete').exists()
+
+
+def test_corrupt_full_size_partial_is_fetched_again(source, tmp_path):
+    (tmp_path / 'model.safetensors.incomplete').write_bytes(b'\0' * len(CONTENT))
+    report = download_model.transfer_file(source, {"commit": "c"}, entry(), str(tmp_path))
+    assert RangeHandler.requests == [None]
+    assert report['bytes'] == len(CONTENT)
+    assert (tmp_path / 'model.safetensors').read_bytes() == CONTENT
+
+
+def test_range_not_satisfiable_restarts_the_file(source, tmp_path):
+    # Without a size in the manifest the partial cannot be judged up front
+    (tmp_path / 'model.safetensors.incomplete').write_bytes(CONTENT)
+    download_model.transfer_file(source, {"commit": "c"}, entry(size=None), str(tmp_path))
+    assert RangeHandler.requests == [f"bytes={len(CONTENT)}-", None]
+    assert (tmp_path / 'model.safetensors').read_bytes() == CONTENT
+
+
+@pytest.mark.parametrize('path', ['../outside.bin', 'a/../../outside.bin', '/etc/passwd', ''])
+def test_manifest_paths_must_stay_in_target(tmp_path, path):
+    manifest = {"commit": "c", "files": [{"path": path, "size": 1}]}
+    with pytest.raises(ValueError):
+        download_model.check_manifest(manifest, str(tmp_path))
+
+
+def test_manifest_paths_through_symlinks_are_refused(tmp_path):
+    os.symlink(str(tmp_path.parent), str(tmp_path / 'link'))
+    manifest = {"commit": "c", "files": [{"path": "link/outside.bin", "size": 1}]}
+    with pytest.raises(ValueError):
+        download_model.check_manifest(manifest, str(tmp_path))
+
+
+def test_manifest_commit_must_be_a_directory_name(tmp_path):
+    with pytest.raises(ValueError):
+        download_model.check_manifest({"commit": "../../etc", "files": []}, str(tmp_path))
+    download_model.check_manifest(
+        {"commit": "abc123", "files": [{"path": "sub/model.safetensors", "size": 1}]}, str(tmp_path))
@@ -0,0 +1,172 @@
+import base64
+import io
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+
+class WordTokenizer:
+    """Two tokens per word, like subword pieces"""
+
+    def encode(self, text, add_special_tokens=True):
+        return [0] * (2 * len(text.split()))
+
+
+class WordStreamModel:
+    """Streams word-sized chunks and stops itself at settings["max_tokens"], like moondream"""
+
+    tokenizer = WordTokenizer()
+
+    def __init__(self, words):
+        self.words = words
+
+    def caption(self, image, length='normal', stream=False, settings=None):
+        budget = settings["max_tokens"] // 2
+
+        def generate():
+            for word in self.words[:budget]:
+                yield word + ' '
+        return {"caption": generate()}
+
+
+def caption(model, max_tokens):
+    return app.run_generation(model.caption, "caption", max_tokens, time.time() + 10,
+                              image=Image.new('RGB', (64, 64)), length='short')
+
+
+def test_generation_stopped_by_model_limit_is_truncated():
+    before = app.generation_stats["truncated"]
+    text, finish_reason = caption(WordStreamModel([f"w{i}" for i in range(50)]), 20)
+    assert len(text.split()) == 10
+    assert finish_reason == "length"
+    assert app.generation_stats["truncated"] == before + 1
+
+
+def test_generation_that_ends_early_is_complete():
+    before = app.generation_stats["completed"]
+    text, finish_reason = caption(WordStreamModel(["a", "small", "cat"]), 20)
+    assert text == "a small cat "
+    assert finish_reason == "stop"
+    assert app.generation_stats["completed"] == before + 1
+
+
+def test_stub_counts_chunks_as_tokens():
+    model = app.StubMoondream(token_delay=0)
+    _, finish_reason = caption(model, 3)
+    assert finish_reason == "length"
+
+
+class ExclusiveStub(app.StubMoondream):
+    """A stub that takes the GPU lock, like the real model"""
+    reentrant = False
+
+
+IMAGE = Image.new('RGB', (64, 64))
+
+
+def data_url():
+    buffer = io.BytesIO()
+    IMAGE.save(buffer, format='PNG')
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def assert_resources_free():
+    assert app.admission.snapshot()['in_use_mb'] == 0
+    assert app.gpu_lock.acquire(blocking=False)
+    app.gpu_lock.release()
+
+
+def test_disconnect_stops_generation_and_frees_the_gpu():
+    model = ExclusiveStub(token_delay=0.01)
+    before = app.generation_stats["aborted_disconnect"]
+    started = time.time()
+    with pytest.raises(app.GenerationAborted) as aborted:
+        app.run_generation(model.caption, "caption", 500, time.time() + 10,
+                           cancelled=lambda: time.time() - started > 0.1, image=IMAGE, length='long')
+    assert aborted.value.reason == "disconnect"
+    assert 0 < len(aborted.value.partial.split()) < 500
+    assert time.time() - started < 2
+    assert app.generation_stats["aborted_disconnect"] == before + 1
+    assert_resources_free()
+
+
+def test_deadline_stops_generation_and_frees_the_gpu():
+    model = ExclusiveStub(token_delay=0.01)
+    before = app.generation_stats["aborted_deadline"]
+    started = time.time()
+    text, finish_reason = app.run_generation(model.caption, "caption", 500, time.time() + 0.2,
+                                             image=IMAGE, length='long')
+    assert finish_reason == "timeout"
+    assert text and time.time() - started < 2
+    assert app.generation_stats["aborted_deadline"] == before + 1
+    assert_resources_free()
+
+
+@pytest.mark.parametrize('reason, timeout, cancelled', [("deadline", 0.3, None), ("disconnect", 5, lambda: True)])
+def test_waiting_for_the_gpu_gives_up(reason, timeout, cancelled):
+    model = ExclusiveStub(token_delay=0)
+    before = app.generation_stats[f"aborted_{reason}"]
+    started = time.time()
+    app.gpu_lock.acquire()
+    try:
+        with pytest.raises(app.GenerationAborted) as aborted:
+            app.run_generation(model.caption, "caption", 10, time.time() + timeout,
+                               cancelled=cancelled, image=IMAGE, length='short')
+    finally:
+        app.gpu_lock.release()
+    assert aborted.value.reason == reason
+    assert time.time() - started < 2
+    assert app.generation_stats[f"aborted_{reason}"] == before + 1
+    assert_resources_free()
+
+
+@pytest.mark.parametrize('body', [
+    {"max_tokens": "ten"}, {"max_tokens": 0}, {"max_tokens": -5}, {"max_tokens": True}, {"max_tokens": 1.5},
+    {"timeout": "soon"}, {"timeout": 0}, {"timeout": -1}, {"timeout": False},
+])
+def test_invalid_generation_budget_is_rejected(client, body):
+    response = client.post('/v1/caption', json=dict(body, image_url=data_url()))
+    assert response.status_code == 400
+    assert ('max_tokens' if 'max_tokens' in body else 'timeout') in response.get_json()['error']
+
+
+def test_generation_budget_is_capped():
+    max_tokens, deadline = app.parse_generation_budget(
+        {"max_tokens": app.MAX_TOKENS_LIMIT + 100, "timeout": app.REQUEST_DEADLINE * 10}, 1000.0)
+    assert max_tokens == app.MAX_TOKENS_LIMIT
+    assert deadline == 1000.0 + app.REQUEST_DEADLINE
+    assert app.parse_generation_budget({}, 0.0) == (app.DEFAULT_MAX_TOKENS, app.REQUEST_DEADLINE)
+
+
+def hold_admission():
+    budget = app.admission.snapshot()['budget_mb']
+    assert app.admission.acquire(budget, timeout=0)
+    return budget
+
+
+def test_deadline_before_admission_returns_504(client):
+    before = app.generation_stats["aborted_deadline"]
+    budget = hold_admission()
+    try:
+        response = client.post('/v1/caption', json={"image_url": data_url(), "timeout": 0.3})
+    finally:
+        app.admission.release(budget)
+    assert response.status_code == 504
+    assert app.generation_stats["aborted_deadline"] == before + 1
+    assert_resources_free()
+
+
+def test_disconnect_before_admission_returns_499(client, monkeypatch):
+    monkeypatch.setattr(app, 'disconnect_watcher', lambda: (lambda: True))
+    before = app.generation_stats["aborted_disconnect"]
+    budget = hold_admission()
+    try:
+        response = client.post('/v1/query', json={"image_url": data_url(), "question": "what?"})
+    finally:
+        app.admission.release(budget)
+    assert response.status_code == 499
+    assert app.generation_stats["aborted_disconnect"] == before + 1
+    assert_resources_free()
@@ -0,0 +1,115 @@
+import base64
+import io
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+MB = 1024 * 1024
+
+
+def image(width=32, height=32, color=(10, 20, 30)):
+    return Image.new('RGB', (width, height), color)
+
+
+def data_url(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    def make(max_items=64, max_bytes=64 * MB, max_encoded=4, max_disk_items=1024, ttl=600):
+        return app.ImageStore(str(tmp_path), max_items, max_bytes, max_encoded, max_disk_items, ttl)
+    return make
+
+
+def test_expired_images_are_forgotten(make_store):
+    store = make_store(ttl=0.05)
+    image_id, _ = store.put(image())
+    assert store.get(image_id) is not None
+    time.sleep(0.1)
+    assert store.get(image_id) is None
+    assert store.stats()['memory'] == 0 and store.stats()['memory_mb'] == 0
+
+
+def test_least_recently_used_spills_to_disk_and_comes_back(make_store):
+    store = make_store(max_items=2)
+    first, _ = store.put(image(color=(1, 2, 3)))
+    second, _ = store.put(image())
+    store.get(first)
+    third, _ = store.put(image())
+    # second was the least recently used
+    assert store.stats()['memory'] == 2 and store.stats()['disk'] == 1
+    assert second in store._disk
+
+    restored, encoded = store.get(second)
+    assert encoded is None
+    assert restored.tobytes() == image().tobytes()
+    # Promoting it spilled the next least recently used (first)
+    assert second in store._memory and first in store._disk
+    assert store.get(first)[0].getpixel((0, 0)) == (1, 2, 3)
+
+
+def test_memory_tier_is_bounded_by_decoded_bytes(make_store):
+    # 1024 x 1024 x 3 bytes = 3 MB each: two fit in 7 MB, three do not
+    store = make_store(max_bytes=7 * MB)
+    ids = [store.put(image(1024, 1024))[0] for _ in range(3)]
+    stats = store.stats()
+    assert stats['memory'] == 2 and stats['disk'] == 1 and stats['memory_mb'] == 6
+    assert ids[0] in store._disk
+    # An image over the whole budget still stays in memory on its own
+    big, _ = store.put(image(2048, 2048))
+    assert list(store._memory) == [big]
+    assert store.stats()['disk'] == 3
+
+
+def test_disk_tier_is_bounded(make_store):
+    store = make_store(max_items=1, max_disk_items=2)
+    ids = [store.put(image())[0] for _ in range(4)]
+    assert store.stats()['disk'] == 2
+    assert store.get(ids[0]) is None
+    assert store.get(ids[3]) is not None
+
+
+def test_only_the_newest_encodings_are_kept(make_store):
+    store = make_store(max_encoded=2)
+    ids = [store.put(image(), encoded=f"encoding-{i}")[0] for i in range(3)]
+    assert store.stats()['encoded'] == 2
+    assert store.get(ids[0]) == (store._memory[ids[0]][0], None)
+    assert store.get(ids[2])[1] == "encoding-2"
+    store.drop_encodings()
+    assert store.stats()['encoded'] == 0
+
+
+@pytest.mark.parametrize('path, body, key', [
+    ('/v1/caption', {"length": "short", "max_tokens": 8}, 'caption'),
+    ('/v1/query', {"question": "what is this?", "max_tokens": 8}, 'answer'),
+])
+def test_image_id_replaces_image_url(client, path, body, key):
+    response = client.post('/v1/images', json={"image_url": data_url(image())})
+    assert response.status_code == 201
+    image_id = response.get_json()['image_id']
+    assert response.get_json()['encoded']
+
+    response = client.post(path, json=dict(body, image_id=image_id))
+    assert response.status_code == 200
+    assert response.get_json()[key]
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/v1/caption', {"length": "short"}),
+    ('/v1/query', {"question": "what is this?"}),
+])
+def test_expired_image_id_is_not_found(client, monkeypatch, tmp_path, path, body):
+    store = app.ImageStore(str(tmp_path), 64, 64 * MB, 4, 1024, 0.05)
+    monkeypatch.setattr(app, 'image_store', store)
+    image_id = client.post('/v1/images', json={"image_url": data_url(image())}).get_json()['image_id']
+    time.sleep(0.1)
+    response = client.post(path, json=dict(body, image_id=image_id))
+    assert response.status_code == 404
+    response = client.post(path, json=dict(body, image_id='img_unknown'))
+    assert response.status_code == 404
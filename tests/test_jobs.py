@@ -0,0 +1,165 @@
+import base64
+import http.server
+import io
+import sqlite3
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+
+@pytest.fixture
+def jobs_db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.db')
+    monkeypatch.setattr(app, 'JOBS_DB_PATH', path)
+    return path
+
+
+def insert_job(job_id, status='queued', started_at=None, attempts=0):
+    conn = app.jobs_db()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, type, payload, status, created_at, started_at, attempts) "
+            "VALUES (?, 'caption', '{}', ?, ?, ?, ?)",
+            (job_id, status, time.time(), started_at, attempts)
+        )
+    finally:
+        conn.close()
+
+
+def job_row(job_id):
+    conn = app.jobs_db()
+    try:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1:8080/hook',
+    'http://localhost/hook',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://10.0.0.5/hook',
+    'http://192.168.1.1/hook',
+    'http://[::1]/hook',
+    'http://[::ffff:127.0.0.1]/hook',
+    'http://0.0.0.0/hook',
+    'ftp://example.com/hook',
+])
+def test_callbacks_to_non_public_addresses_are_refused(url):
+    with pytest.raises(ValueError):
+        app.resolve_callback(url)
+
+
+def test_public_callback_address_is_accepted():
+    parts, port, address = app.resolve_callback('https://93.184.216.34/hooks/moondream?x=1')
+    assert (parts.hostname, port, address) == ('93.184.216.34', 443, '93.184.216.34')
+
+
+def test_allowlist_replaces_the_address_check(monkeypatch):
+    monkeypatch.setattr(app, 'JOB_CALLBACK_HOSTS', {'localhost'})
+    assert app.resolve_callback('http://localhost:9000/hook')[1] == 9000
+    with pytest.raises(ValueError):
+        app.resolve_callback('https://93.184.216.34/hook')
+
+
+def test_callback_does_not_follow_redirects(monkeypatch):
+    hits = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            hits.append(self.path)
+            self.send_response(307)
+            self.send_header('Location', '/internal')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setattr(app, 'JOB_CALLBACK_HOSTS', {'127.0.0.1'})
+        app.send_callback(f'http://127.0.0.1:{server.server_port}/hook?job=1', {"job_id": "job_test"})
+    finally:
+        server.shutdown()
+    assert hits == ['/hook?job=1']
+
+
+def test_claim_counts_attempts_and_gives_up(jobs_db_path, monkeypatch):
+    monkeypatch.setattr(app, 'JOB_MAX_ATTEMPTS', 2)
+    insert_job('job_a')
+
+    row, abandoned = app.claim_job()
+    assert row['id'] == 'job_a' and abandoned == []
+    assert job_row('job_a')['attempts'] == 1
+
+    # The worker died: the lease expires and the job is claimed again
+    monkeypatch.setattr(app, 'JOB_LEASE_SECONDS', 0)
+    time.sleep(0.01)
+    row, abandoned = app.claim_job()
+    assert row['id'] == 'job_a'
+    assert job_row('job_a')['attempts'] == 2
+
+    time.sleep(0.01)
+    row, abandoned = app.claim_job()
+    assert row is None and abandoned == ['job_a']
+    failed = job_row('job_a')
+    assert failed['status'] == 'failed'
+    assert 'after 2 attempts' in failed['error']
+    assert app.job_to_dict(failed)['attempts'] == 2
+
+
+def test_abandoned_job_does_not_block_the_next(jobs_db_path, monkeypatch):
+    monkeypatch.setattr(app, 'JOB_LEASE_SECONDS', 0)
+    insert_job('job_old', status='running', started_at=time.time() - 1, attempts=app.JOB_MAX_ATTEMPTS)
+    insert_job('job_new')
+    row, abandoned = app.claim_job()
+    assert row['id'] == 'job_new'
+    assert abandoned == ['job_old']
+
+
+def test_existing_database_gains_attempts_column(jobs_db_path):
+    conn = sqlite3.connect(jobs_db_path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, type TEXT NOT NULL, payload TEXT NOT NULL, "
+        "status TEXT NOT NULL, result TEXT, error TEXT, callback_url TEXT, "
+        "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+    )
+    conn.execute("INSERT INTO jobs (id, type, payload, status, created_at) "
+                 "VALUES ('job_legacy', 'caption', '{}', 'queued', 0)")
+    conn.commit()
+    conn.close()
+
+    row, _ = app.claim_job()
+    assert row['id'] == 'job_legacy'
+    assert job_row('job_legacy')['attempts'] == 1
+
+
+def test_lease_outlasts_the_job_deadline():
+    assert app.JOB_LEASE_SECONDS > app.JOB_TIMEOUT + app.INFERENCE_GRACE
+
+
+def test_claimed_row_carries_its_claim(jobs_db_path):
+    insert_job('job_a')
+    before = time.time()
+    row, _ = app.claim_job()
+    assert row['status'] == 'running'
+    assert row['attempts'] == 1
+    assert row['started_at'] >= before
+
+
+def test_job_deadline_runs_from_the_claim():
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32)).save(buffer, format='PNG')
+    payload = {"image_url": "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode(),
+               "max_tokens": 8, "length": "short"}
+    # Claimed longer ago than JOB_TIMEOUT: no time is left to generate
+    assert app.run_job('caption', payload, time.time() - app.JOB_TIMEOUT - 1)['finish_reason'] == 'timeout'
+    result = app.run_job('caption', payload, time.time())
+    assert result['finish_reason'] in ('stop', 'length') and result['caption']
@@ -0,0 +1,84 @@
+import io
+import json
+import logging
+import sys
+
+import app
+
+
+def make_record(msg='hello %s', args=('world',), level=logging.INFO, exc_info=None, **extra):
+    record = logging.LogRecord('moondream', level, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def formatted(record):
+    return json.loads(app.JsonFormatter().format(record))
+
+
+def test_formatter_writes_one_json_object():
+    entry = formatted(make_record())
+    assert entry["msg"] == "hello world"
+    assert entry["level"] == "info" and entry["logger"] == "moondream"
+    assert "request_id" not in entry and "exc" not in entry
+
+
+def test_formatter_merges_request_id_and_fields():
+    entry = formatted(make_record(request_id='caption_1', fields={"tokens": 12, "size": (64, 48)}))
+    assert entry["request_id"] == 'caption_1'
+    assert entry["tokens"] == 12
+    assert entry["size"] == [64, 48]
+
+
+def test_fields_do_not_replace_the_record_keys():
+    entry = formatted(make_record(request_id='caption_1',
+                                  fields={"msg": "spoofed", "level": "error", "request_id": "other", "x": 1}))
+    assert (entry["msg"], entry["level"], entry["request_id"]) == ("hello world", "info", "caption_1")
+    assert entry["x"] == 1
+
+
+def test_formatter_serialises_unknown_values_and_exceptions():
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        exc_info = sys.exc_info()
+    entry = formatted(make_record(exc_info=exc_info, fields={"obj": object()}))
+    assert entry["obj"].startswith("<object object")
+    assert "ValueError: bad" in entry["exc"]
+
+
+def test_parse_sample_rates():
+    assert app.parse_sample_rates("debug=0.01, INFO=1") == {logging.DEBUG: 0.01, logging.INFO: 1.0}
+    assert app.parse_sample_rates("") == {}
+    assert app.parse_sample_rates(" warning=0 ,") == {logging.WARNING: 0.0}
+
+
+def test_sampling_filter_keeps_the_configured_fraction(monkeypatch):
+    sampling = app.SamplingFilter({logging.DEBUG: 0.25, logging.INFO: 0.0})
+    values = iter([0.1, 0.5, 0.2, 0.9, 0.0])
+    monkeypatch.setattr(app.random, 'random', lambda: next(values))
+    debug = [sampling.filter(make_record(level=logging.DEBUG)) for _ in range(4)]
+    assert debug == [True, False, True, False]
+    assert not sampling.filter(make_record(level=logging.INFO))
+    # Levels without a rate are always kept
+    assert sampling.filter(make_record(level=logging.ERROR))
+
+
+def test_async_handler_drops_and_counts_when_full():
+    stream = io.StringIO()
+    # A long interval keeps the background writer out of the way
+    handler = app.AsyncLogHandler(stream, maxsize=3, interval=3600)
+    handler.setFormatter(app.JsonFormatter())
+    for i in range(5):
+        handler.emit(make_record(msg='record %d', args=(i,)))
+    assert handler.dropped == 2
+    assert stream.getvalue() == ''
+
+    handler.drain()
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line)["msg"] for line in lines] == ['record 0', 'record 1', 'record 2']
+    # Draining makes room again
+    handler.emit(make_record())
+    handler.drain()
+    assert len(stream.getvalue().splitlines()) == 4
+    assert handler.dropped == 2
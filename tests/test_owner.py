@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+IMAGE = Image.new('RGB', (64, 48), (200, 100, 50))
+
+
+class ExclusiveStub(app.StubMoondream):
+    """A stub that takes the GPU lock, like the real model"""
+    reentrant = False
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture(scope='module')
+def socket_path():
+    # The owner and its clients share this process: the owner serves from a thread
+    directory = tempfile.mkdtemp(prefix='moondream-owner-')
+    path = os.path.join(directory, 'inference.sock')
+    threading.Thread(target=app.serve_inference, args=(path,), daemon=True).start()
+    assert wait_until(lambda: os.path.exists(path))
+    yield path
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def remote(socket_path, monkeypatch):
+    monkeypatch.setattr(app, 'moondream', ExclusiveStub(token_delay=0.01))
+    return app.RemoteModel(socket_path)
+
+
+def test_caption_and_query_through_shared_memory(remote):
+    text, finish_reason = app.run_generation(remote.caption, "caption", 6, time.time() + 10,
+                                             image=IMAGE, length='short')
+    assert text and finish_reason in ('stop', 'length')
+    text, finish_reason = app.run_generation(remote.query, "answer", 6, time.time() + 10,
+                                             image=IMAGE, question="what colour is it?")
+    assert text and finish_reason in ('stop', 'length')
+
+
+def test_shared_image_round_trip():
+    with app.shared_image(IMAGE) as fields:
+        copy = app.attach_shared_image(fields['shm'], fields['size'])
+    assert copy.size == IMAGE.size
+    assert copy.tobytes() == IMAGE.tobytes()
+
+
+def test_put_image_then_query_by_image_id(remote):
+    image_id, expires_at, encoded = remote.store_image(IMAGE, True, time.time() + 10)
+    assert encoded and expires_at > time.time()
+    # The image lives in the owner's registry, not the client's
+    stored, encoding = app.image_store.get(image_id)
+    assert stored.tobytes() == IMAGE.tobytes() and encoding is not None
+
+    text, finish_reason = app.run_generation(remote.query, "answer", 6, time.time() + 10,
+                                             image=app.StoredImage(image_id), question="what is this?")
+    assert text and finish_reason in ('stop', 'length')
+
+
+def test_unknown_image_id_is_not_found(remote):
+    with pytest.raises(app.ImageNotFound):
+        app.run_generation(remote.caption, "caption", 6, time.time() + 10,
+                           image=app.StoredImage('img_unknown'), length='short')
+
+
+def test_closing_the_connection_cancels_the_owner_generation(remote):
+    before = app.generation_stats["aborted_disconnect"]
+    started = time.time()
+    with pytest.raises(app.GenerationAborted) as aborted:
+        app.run_generation(remote.caption, "caption", 500, time.time() + 30,
+                           cancelled=lambda: time.time() - started > 0.2, image=IMAGE, length='long')
+    assert aborted.value.reason == "disconnect"
+    # The owner notices the closed socket, stops generating and frees the GPU
+    assert wait_until(lambda: app.generation_stats["aborted_disconnect"] == before + 1)
+    assert wait_until(lambda: app.admission.snapshot()['in_use_mb'] == 0)
+    assert app.gpu_lock.acquire(timeout=2)
+    app.gpu_lock.release()
+    assert time.time() - started < 5
+
+
+def test_status_and_unknown_ops(remote):
+    status = remote.call({"op": "status"}, time.time() + 10)
+    assert status["model_id"] == app.MODEL_ID
+    assert status["admission"]["in_use_mb"] == 0
+    assert "error" in remote.call({"op": "nope"}, time.time() + 10)
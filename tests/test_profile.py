@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+import app
+
+
+def sampled_names(trace):
+    return {event['name'] for event in trace['traceEvents'] if event.get('cat') == 'sample'}
+
+
+def test_profile_refused_without_admin_key(client, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILING_ENABLED', True)
+    monkeypatch.setattr(app, 'ADMIN_API_KEY', '')
+    response = client.get('/debug/profile?seconds=0.1')
+    assert response.status_code == 404
+    assert 'ADMIN_API_KEY' in response.get_json()['error']
+
+
+def test_profile_requires_the_admin_key(client, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILING_ENABLED', True)
+    monkeypatch.setattr(app, 'VLM_API_KEY', 'test-key')
+    assert client.get('/debug/profile?seconds=0.1').status_code == 401
+    # The inference key is not enough
+    response = client.get('/debug/profile?seconds=0.1', headers={'X-Moondream-Auth': 'test-key'})
+    assert response.status_code == 401
+    response = client.get('/debug/profile?seconds=0.1', headers={'X-Moondream-Admin-Auth': app.ADMIN_API_KEY})
+    assert response.status_code == 200
+    assert response.get_json()['otherData']['samples'] > 0
+
+
+def test_parked_greenlets_are_sampled():
+    greenlet = pytest.importorskip('greenlet')
+    main = greenlet.getcurrent()
+
+    def parked_request_handler():
+        main.switch()
+
+    def started_during_profile():
+        main.switch()
+
+    before = greenlet.greenlet(parked_request_handler)
+    before.switch()
+
+    profile = app.Profile(interval=0.005)
+    profile.start()
+    during = greenlet.greenlet(started_during_profile)
+    during.switch()
+    time.sleep(0.1)
+    profile.stop()
+
+    names = sampled_names(profile.trace())
+    assert any(name.startswith('parked_request_handler ') for name in names)
+    assert any(name.startswith('started_during_profile ') for name in names)
+    assert greenlet.gettrace() is None
+    before.switch()
+    during.switch()
+
+
+def test_torch_events_share_the_profile_clock():
+    pytest.importorskip('torch.profiler')
+    import torch
+    profile = app.Profile()
+    torch_prof = app.start_torch_profiler()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    torch.ones(64, 64) @ torch.ones(64, 64)
+    end = time.perf_counter()
+    time.sleep(0.05)
+    events = app.stop_torch_profiler(torch_prof, profile.origin)
+
+    assert events and all(e['pid'] == app.TRACE_PID_TORCH for e in events)
+    assert not any(e.get('name') == app.TORCH_CLOCK_ANCHOR for e in events)
+    matmuls = [e for e in events if e.get('ph') == 'X' and e.get('name') in ('aten::matmul', 'aten::mm')]
+    assert matmuls
+    # Within a millisecond of where perf_counter() saw it run
+    for event in matmuls:
+        assert profile._ts(start) - 1000 <= event['ts'] <= profile._ts(end) + 1000
@@ -0,0 +1,113 @@
+import threading
+import time
+import weakref
+
+from PIL import Image
+
+import app
+
+ADMIN = {'X-Moondream-Admin-Auth': 'test-admin-key'}
+
+
+def wait_until(predicate, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def start_caption(model, max_tokens, result):
+    """Run a long caption on model in a thread; its (text, finish_reason) lands in result"""
+    def generate(caption):
+        result['value'] = app.run_generation(caption, 'caption', max_tokens, time.time() + 30,
+                                             image=Image.new('RGB', (64, 64)), length='long')
+    worker = threading.Thread(target=generate, args=(model.caption,))
+    worker.start()
+    return worker
+
+
+def test_reload_requires_admin_key(client):
+    assert client.post('/admin/reload').status_code == 401
+    assert client.post('/admin/reload', headers={'X-Moondream-Admin-Auth': 'wrong'}).status_code == 401
+
+
+def test_reload_disabled_without_admin_key(client, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_API_KEY', '')
+    assert client.post('/admin/reload', headers=ADMIN).status_code == 404
+
+
+def test_reload_rejects_unlisted_targets(client):
+    response = client.post('/admin/reload', headers=ADMIN, json={'model_id': 'someone/else'})
+    assert response.status_code == 400
+    response = client.post('/admin/reload', headers=ADMIN, json={'revision': 'unlisted'})
+    assert response.status_code == 400
+
+
+def test_reload_swaps_model_finishes_in_flight_and_releases_old(client):
+    old = app.moondream
+    result = {}
+    worker = start_caption(old, 100, result)
+    time.sleep(0.1)
+
+    assert client.post('/admin/reload', headers=ADMIN).status_code == 202
+    assert wait_until(lambda: app.reload_state['status'] == 'done')
+    assert app.moondream is not old
+    # The in-flight request keeps generating on the previous model
+    assert worker.is_alive()
+
+    retired = weakref.ref(old)
+    del old
+    worker.join()
+    text, finish_reason = result['value']
+    assert finish_reason == 'length'
+    assert len(text.split()) == 100
+    assert wait_until(lambda: retired() is None)
+    assert client.get('/admin/reload', headers=ADMIN).json['active']['model_id'] == app.MODEL_ID
+
+
+def test_warm_up_waits_for_admission(client, monkeypatch):
+    # Serial admission (no budget): the warm-up must not run beside a live generation
+    monkeypatch.setattr(app, 'GPU_MEMORY_BUDGET_MB', 0)
+    monkeypatch.setattr(app, 'admission', app.MemoryAdmission(1.0))
+    result = {}
+    worker = start_caption(app.moondream, 50, result)
+    time.sleep(0.1)
+
+    assert client.post('/admin/reload', headers=ADMIN).status_code == 202
+    time.sleep(0.2)
+    assert worker.is_alive()
+    assert app.reload_state['status'] == 'loading'
+
+    worker.join()
+    assert wait_until(lambda: app.reload_state['status'] == 'done')
+    assert result['value'][1] == 'length'
+
+
+def test_sighup_in_client_worker_forwards_to_owner(monkeypatch):
+    calls = []
+
+    class Owner:
+        def call(self, message, deadline):
+            calls.append(message)
+            return {"started": True, "reload": {"status": "loading"}}
+
+    owner = Owner()
+    monkeypatch.setattr(app, 'INFERENCE_MODE', 'client')
+    monkeypatch.setattr(app, 'moondream', owner)
+    monkeypatch.setattr(app, 'start_model_reload', lambda *args: calls.append('local reload'))
+    app.handle_reload_signal(1, None)
+    assert wait_until(lambda: calls)
+    assert calls == [{"op": "reload", "model_id": app.MODEL_ID, "revision": app.MODEL_REVISION}]
+    assert app.moondream is owner
+
+
+def test_health_keeps_the_short_model_name(client, monkeypatch):
+    monkeypatch.setitem(app.active_model, 'model_id', 'moondream/moondream-2b-2025-04-14')
+    monkeypatch.setitem(app.active_model, 'revision', '2025-06-21')
+    health = client.get('/health').get_json()
+    assert health['model'] == 'moondream-2b-2025-04-14'
+    assert health['model_id'] == 'moondream/moondream-2b-2025-04-14'
+    assert health['revision'] == '2025-06-21'
+    assert app.model_name('/models/snapshot/') == 'snapshot'
@@ -0,0 +1,58 @@
+import pytest
+
+nn = pytest.importorskip('torch.nn')
+import torch  # noqa: E402
+
+import snapshot  # noqa: E402
+
+
+class Toy(nn.Module):
+    """Tied weights, a persistent buffer and one computed in __init__"""
+
+    def __init__(self):
+        super().__init__()
+        self.embed = nn.Embedding(10, 4)
+        self.block = nn.Sequential(nn.Linear(4, 8), nn.LayerNorm(8), nn.Linear(8, 4))
+        self.head = nn.Linear(4, 10, bias=False)
+        self.head.weight = self.embed.weight
+        self.register_buffer('scale', torch.ones(4))
+        self.register_buffer('positions', torch.arange(6), persistent=False)
+
+
+def build(path, dtype):
+    return Toy()
+
+
+def test_round_trip_attaches_every_tensor(tmp_path):
+    model = Toy()
+    with torch.no_grad():
+        model.scale.mul_(3)
+    manifest = snapshot.save_snapshot(model, str(tmp_path), 'float32', model_id='toy')
+    assert snapshot.is_snapshot(str(tmp_path))
+    assert manifest['model_id'] == 'toy'
+    assert 'head.weight' in manifest['parameters'] and 'positions' in manifest['buffers']
+
+    loaded = snapshot.load_snapshot(str(tmp_path), build=build)
+    expected = dict(model.named_parameters(remove_duplicate=False))
+    for name, param in loaded.named_parameters(remove_duplicate=False):
+        assert not param.is_meta, name
+        assert torch.equal(param, expected[name]), name
+    expected = dict(model.named_buffers(remove_duplicate=False))
+    for name, buffer in loaded.named_buffers(remove_duplicate=False):
+        assert not buffer.is_meta, name
+        assert torch.equal(buffer, expected[name]), name
+    assert not any(t.is_meta for t in loaded.state_dict().values())
+    assert not loaded.training
+
+    tokens = torch.tensor([[1, 2, 3]])
+    with torch.no_grad():
+        x = loaded.embed(tokens)
+        assert torch.equal(loaded.head(loaded.block(x)), model.head(model.block(model.embed(tokens))))
+
+
+def test_floating_tensors_are_stored_in_the_serving_dtype(tmp_path):
+    snapshot.save_snapshot(Toy(), str(tmp_path), 'bfloat16')
+    loaded = snapshot.load_snapshot(str(tmp_path), build=build)
+    assert loaded.block[0].weight.dtype == torch.bfloat16
+    # Integer buffers keep their dtype
+    assert loaded.positions.dtype == torch.int64
@@ -0,0 +1,118 @@
+import io
+import json
+import threading
+import time
+
+from PIL import Image
+
+import app
+
+
+class RecordingSocket:
+    """Stands in for a WebSocket; fails the test on overlapping sends"""
+
+    def __init__(self):
+        self.messages = []
+        self.overlaps = 0
+        self._sending = False
+
+    def send(self, data):
+        if self._sending:
+            self.overlaps += 1
+        self._sending = True
+        time.sleep(0.001)
+        self.messages.append(json.loads(data))
+        self._sending = False
+
+
+def frame_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def test_sends_from_worker_and_receive_loop_do_not_interleave():
+    ws = RecordingSocket()
+    stream = app.FrameStream(ws)
+    threads = [
+        threading.Thread(target=lambda: [stream.send({"type": "ready", "n": i}) for i in range(50)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ws.overlaps == 0
+    assert len(ws.messages) == 200
+
+
+def test_worker_answers_frames_while_control_messages_are_sent():
+    ws = RecordingSocket()
+    stream = app.FrameStream(ws)
+    worker = threading.Thread(target=app.answer_frames, args=(stream,))
+    worker.start()
+    stream.configure({"question": "what is this?", "max_tokens": 8})
+    stream.push(frame_bytes())
+    # Keep replying on the receive side while the worker answers the frame
+    deadline = time.time() + 10
+    while not any(m['type'] == 'result' for m in ws.messages) and time.time() < deadline:
+        stream.send({"type": "ready", "task": stream.task})
+    stream.close()
+    worker.join(timeout=10)
+    assert ws.overlaps == 0
+    results = [m for m in ws.messages if m['type'] == 'result']
+    assert len(results) == 1 and results[0]['frame'] == 1 and results[0]['answer']
+
+
+class QueuedSocket:
+    """Replays a fixed list of received messages"""
+
+    def __init__(self, *messages):
+        self.messages = list(messages)
+
+    def receive(self, timeout=None):
+        return self.messages.pop(0) if self.messages else None
+
+
+def test_auth_message_carries_the_key():
+    assert app.read_auth_message(QueuedSocket('{"type": "auth", "api_key": "k"}')) == 'k'
+    # A timeout, a frame or a control message first is not an auth message
+    assert app.read_auth_message(QueuedSocket()) == ''
+    assert app.read_auth_message(QueuedSocket(frame_bytes())) == ''
+    assert app.read_auth_message(QueuedSocket('{"question": "hi"}')) == ''
+    assert app.read_auth_message(QueuedSocket('[1]')) == ''
+
+
+def test_api_key_comparison(monkeypatch):
+    monkeypatch.setattr(app, 'VLM_API_KEY', 'secret')
+    assert app.api_key_valid('secret')
+    assert not app.api_key_valid('secre')
+    assert not app.api_key_valid('')
+    assert not app.api_key_valid(None)
+    assert not app.api_key_valid('sécret')
+
+
+def test_only_the_newest_frame_is_answered(monkeypatch):
+    # Slow enough that the later frames all arrive during the first generation
+    monkeypatch.setattr(app, 'moondream', app.StubMoondream(token_delay=0.05))
+    ws = RecordingSocket()
+    stream = app.FrameStream(ws)
+    worker = threading.Thread(target=app.answer_frames, args=(stream,))
+    worker.start()
+    stream.configure({"length": "short", "max_tokens": 8})
+    stream.push(frame_bytes())
+    deadline = time.time() + 10
+    while stream.frame is not None and time.time() < deadline:
+        time.sleep(0.005)
+    # Frame 1 is being answered; 2-4 are each replaced by the next
+    for _ in range(4):
+        stream.push(frame_bytes())
+
+    while len(ws.messages) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    stream.close()
+    worker.join(timeout=10)
+    assert [m['type'] for m in ws.messages] == ['result', 'result']
+    assert [m['frame'] for m in ws.messages] == [1, 5]
+    assert ws.messages[-1]['dropped'] == 3
+    assert (stream.received, stream.dropped) == (5, 3)